@@ -0,0 +1,109 @@
+import json
+from datetime import datetime
+from flask import Blueprint, Response, request, stream_with_context
+from models import db, tag_registry, User, Post, Tag, PostTag
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# How many rows to pull from the server-side cursor at a time when streaming a collection
+STREAM_BATCH_SIZE = 1000
+
+# The most suggestions the tag autocomplete will return
+MAX_AUTOCOMPLETE = 50
+
+USER_FIELDS = (User.id, User.first_name, User.last_name, User.image, User.updated_at)
+POST_FIELDS = (Post.id, Post.user_id, Post.title, Post.content, Post.created_at, Post.updated_at)
+TAG_FIELDS = (Tag.id, Tag.name, Tag.updated_at)
+
+def to_json(value):
+    """Serialize the values our columns hold that json doesn't know about."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def row_dict(obj, fields):
+    """Pick the given columns off a model instance or a row as a dict."""
+    return {field.key: getattr(obj, field.key) for field in fields}
+
+def json_response(data):
+    """Send a single JSON document, with datetimes in the same ISO format as the streamed collections."""
+    return Response(json.dumps(data, default=to_json), mimetype='application/json')
+
+def stream_ndjson(query):
+    """
+    Stream the rows of a column query as newline-delimited JSON.
+    Rows come from a server-side cursor a batch at a time and are never turned into ORM objects,
+    so exporting a whole table runs in constant memory.
+    """
+    rows = query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        for row in rows:
+            yield json.dumps(row._asdict(), default=to_json) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@api.route('/users')
+def list_users():
+    """Stream every user as NDJSON, in id order."""
+    return stream_ndjson(db.session.query(*USER_FIELDS).order_by(User.id))
+
+@api.route('/users/<int:user_id>')
+def get_user(user_id):
+    """
+    Get one user and how many posts they have. 404 if the user doesn't exist.
+    Their posts are streamed by /api/users/<id>/posts, so a prolific user doesn't make this one big response.
+    """
+    user = User.query.get_or_404(user_id)
+    data = row_dict(user, USER_FIELDS)
+    data['post_count'] = user.post_count
+    return json_response(data)
+
+@api.route('/users/<int:user_id>/posts')
+def list_user_posts(user_id):
+    """Stream all of a user's posts as NDJSON, in id order. 404 if the user doesn't exist."""
+    User.query.get_or_404(user_id)
+    return stream_ndjson(db.session.query(*POST_FIELDS).filter(Post.user_id == user_id).order_by(Post.id))
+
+@api.route('/posts')
+def list_posts():
+    """Stream every post as NDJSON, in id order."""
+    return stream_ndjson(db.session.query(*POST_FIELDS).order_by(Post.id))
+
+@api.route('/posts/<int:post_id>')
+def get_post(post_id):
+    """Get one post with the ids and names of its tags. 404 if the post doesn't exist."""
+    post = Post.get_details_or_404(post_id)
+    data = row_dict(post, POST_FIELDS)
+    data['tags'] = [{'id': tag.id, 'name': tag.name} for tag in post.tags]
+    return json_response(data)
+
+@api.route('/tags')
+def list_tags():
+    """Stream every tag as NDJSON, in alphabetical order."""
+    return stream_ndjson(db.session.query(*TAG_FIELDS).order_by(Tag.name))
+
+@api.route('/tags/autocomplete')
+def autocomplete_tags():
+    """
+    Get the tags whose names start with the q arg, in name order, as a JSON list of ids and names.
+    Answered from the in-memory tag registry, so it doesn't touch the DB.
+    """
+    prefix = request.args.get('q', '').strip().lower()
+    limit = max(1, min(request.args.get('limit', 10, type=int), MAX_AUTOCOMPLETE))
+    if not prefix:
+        return json_response([])
+    return json_response([tag._asdict() for tag in tag_registry.complete(prefix, limit)])
+
+@api.route('/tags/<int:tag_id>')
+def get_tag(tag_id):
+    """Get one tag. 404 if the tag doesn't exist."""
+    tag = Tag.query.get_or_404(tag_id)
+    return json_response(row_dict(tag, TAG_FIELDS))
+
+@api.route('/tags/<int:tag_id>/posts')
+def list_tag_posts(tag_id):
+    """Stream all of the posts with a tag as NDJSON, in id order. 404 if the tag doesn't exist."""
+    Tag.query.get_or_404(tag_id)
+    query = db.session.query(*POST_FIELDS).join(PostTag).filter(PostTag.tag_id == tag_id).order_by(Post.id)
+    return stream_ndjson(query)
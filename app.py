@@ -1,57 +1,229 @@
-from flask import Flask, request, render_template, redirect
+import hashlib
+import click
+from datetime import datetime
+from functools import wraps
+from flask import Flask, Blueprint, current_app, request, render_template, redirect, abort, g, jsonify, make_response
+from flask.cli import with_appcontext
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import is_resource_modified
 from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
-
-app = Flask(__name__)
-
-app.config['SECRET_KEY'] = 'blogly4567'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-
-debug = DebugToolbarExtension(app)
-
-connect_db(app)
-
-@app.route('/')
+from models import db, connect_db, repair_post_counts, tag_registry, related_index, User, Post, Tag, PostTag, POST_LIST_COLUMNS
+from pagination import keyset_page
+from cache import page_cache
+from config import config_from_env, engine_options
+from api import api
+from writebehind import write_queue, QueueFull
+from registry import TagEntry
+import instrumentation
+import routing
+import fragments
+import transfer
+
+views = Blueprint('blogly', __name__)
+
+# How many related posts and related tags the post page shows
+RELATED_POSTS = 5
+RELATED_TAGS = 5
+
+# The most tags /posts can be filtered by at once
+MAX_FILTER_TAGS = 10
+
+# The deepest page of search results, since each page skips all the ones before it with OFFSET
+MAX_SEARCH_PAGE = 100
+
+def create_app(config=None):
+    """
+    Build the app, with settings from the environment (see config.py) overridden by the config dict passed.
+    Nothing connects to the database here: the engine and its pool are created on first use,
+    so each gunicorn worker process opens its own connections after it forks.
+    """
+    app = Flask(__name__)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    # Statement echo and the debug toolbar are for development only; /metrics gives the numbers everywhere else
+    app.config.setdefault('SQLALCHEMY_ECHO', app.debug)
+
+    if app.debug:
+        DebugToolbarExtension(app)
+
+    routing.init_app(app)
+    connect_db(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    app.cli.add_command(repair_counts_command)
+    app.cli.add_command(transfer.blogly)
+    instrumentation.init_app(app)
+    fragments.init_app(app)
+    page_cache.configure(max_size=app.config['PAGE_CACHE_SIZE'], ttl=app.config['PAGE_CACHE_TTL'])
+    tag_registry.configure(ttl=app.config['TAG_REGISTRY_TTL'])
+    related_index.configure(ttl=app.config['RELATED_INDEX_TTL'])
+    write_queue.configure(app)
+    return app
+
+def cached_page(view):
+    """
+    Serve a read-only view from the page cache when we can, keyed on the path and query string.
+    The view records which rows the page was built from with depends_on(), so the write paths can invalidate it:
+    'users', 'posts' and 'tags' for the lists, ('user', id), ('post', id) and ('tag', id) for a single row,
+    and ('user_posts', id) / ('tag_posts', id) for the set of posts belonging to a user or tag.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.full_path
+        html = page_cache.get(key)
+        if html is None:
+            generation = page_cache.generation
+            g.page_deps = set()
+            html = view(*args, **kwargs)
+            if not routing.may_be_stale():
+                page_cache.set(key, html, g.page_deps, generation=generation)
+        return html
+    return wrapper
+
+def depends_on(*deps):
+    """Record dependency keys for the page the current cached_page view is rendering."""
+    g.page_deps.update(deps)
+
+def conditional(version):
+    """
+    Make a details view answer conditional requests.
+    version is called with the view's arguments and should cheaply return the timestamps and counts the page
+    was built from, or None if the row doesn't exist (404).
+    We send a strong ETag and Last-Modified with the page, and a 304 with no body when the client's copy is still current,
+    before the view (or the page cache) is touched.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            stamp = version(*args, **kwargs)
+            if stamp is None:
+                abort(404)
+
+            etag, last_modified = version_validators(request.full_path, stamp)
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = make_response('', 304)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+def parse_tag_filter(tags, mode):
+    """
+    Read the tags arg of /posts, a comma separated list of tag names, and the mode arg, all (the default) or any.
+    Returns the sorted, lowercased names and whether posts must have all of them.
+    Raises ValueError if the mode isn't one of those or there are more than MAX_FILTER_TAGS names.
+    """
+    names = sorted({name.strip().lower() for name in tags.split(',') if name.strip()})
+    if mode not in ('all', 'any') or len(names) > MAX_FILTER_TAGS:
+        raise ValueError(f'Invalid tag filter: {tags!r} {mode!r}')
+    return names, mode == 'all'
+
+def version_validators(full_path, stamp):
+    """The strong ETag and the Last-Modified time of the page at full_path, from what its version() returned."""
+    etag = hashlib.sha1(f'{full_path}|{tuple(stamp)!r}'.encode()).hexdigest()
+    last_modified = max(value for value in stamp if isinstance(value, datetime))
+    return etag, last_modified
+
+def paginate(query, columns, descending=False):
+    """
+    Get the page of the query asked for by the request's after/before cursors and per_page args.
+    400 if the cursor is malformed.
+    """
+    per_page = request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+    try:
+        return keyset_page(query, columns,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            per_page=per_page,
+                            descending=descending)
+    except ValueError:
+        abort(400)
+
+def write(method, *args, **kwargs):
+    """
+    Make a write with one of the models' methods that take a commit argument, like User.commit_new_user:
+    now, or on the write-behind queue if WRITE_BEHIND is on (see writebehind.py). 503 if the queue is full.
+    """
+    if not current_app.config['WRITE_BEHIND']:
+        return method(*args, **kwargs)
+
+    try:
+        write_queue.submit(method, *args, **kwargs)
+    except QueueFull:
+        raise ServiceUnavailable('Too many submissions right now, please try again.', retry_after=1)
+    # Keep the client on the primary (see routing.py), where the write is about to land
+    g.db_wrote = True
+
+@click.command('repair-counts')
+@with_appcontext
+def repair_counts_command():
+    """Recompute the post counts of every user and tag."""
+    users_fixed, tags_fixed = repair_post_counts()
+    print(f'Fixed post counts for {users_fixed} users and {tags_fixed} tags')
+
+@views.route('/')
 def redirect_to_users():
     "Redirect user from the root directory to the users list"
     return redirect('/users')
 
-@app.route('/users')
-def show_users():
-    "Show a full list of all users"
-    users = User.query.all()
-    return render_template('users.html', users=users)
+@views.route('/cache/stats')
+def show_cache_stats():
+    """Show the page cache's hit/miss counters as JSON."""
+    return jsonify(page_cache.stats())
 
-@app.route('/users/new')
+@views.route('/users')
+@cached_page
+def show_users():
+    "Show a page of the list of users, in the order they signed up, or with the most posts first if sort=popular"
+    if request.args.get('sort') == 'popular':
+        page = paginate(User.query, [User.post_count, User.id], descending=True)
+        depends_on('users', 'user_counts')
+    else:
+        page = paginate(User.query, [User.id])
+        depends_on('users', *(('user_posts', user.id) for user in page.items))
+    return render_template('users.html', users=page.items, page=page)
+
+@views.route('/users/new')
 def show_new_user_form():
     "Show the form for submitting a new user"
     return render_template('new-user.html')
 
-@app.route('/users/new', methods=["POST"])
+@views.route('/users/new', methods=["POST"])
 def add_user():
     """Collect the inputs from the form sent to this route, and then commit a new user from those inputs"""
     first = request.form['first']
     last = request.form['last']
     image = request.form['image']
 
-    User.commit_new_user(first=first, last=last, image=image)
+    write(User.commit_new_user, first=first, last=last, image=image)
     return redirect('/users')
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
+@conditional(User.version)
+@cached_page
 def show_user_details(user_id):
-    """Show the details page for the given user. 404 if that user is not found."""
+    """Show the details page for the given user, with a page of their posts, newest first. 404 if that user is not found."""
     user = User.query.get_or_404(user_id)
-    return render_template('user-details.html', user=user)
+    page = paginate(Post.query.options(db.load_only(*POST_LIST_COLUMNS)).filter(Post.user_id == user_id),
+                    [Post.created_at, Post.id], descending=True)
+    depends_on(('user', user_id), ('user_posts', user_id), *(('post', post.id) for post in page.items))
+    return render_template('user-details.html', user=user, posts=page.items, page=page)
 
-@app.route('/users/<int:user_id>/edit')
+@views.route('/users/<int:user_id>/edit')
 def show_user_edit_form(user_id):
     """Show the form to edit a given user's details. 404 if that user is not found."""
     user = User.query.get_or_404(user_id)
     return render_template('user-edit.html', user=user)
 
-@app.route('/users/<int:user_id>/edit', methods=['POST'])
+@views.route('/users/<int:user_id>/edit', methods=['POST'])
 def edit_user(user_id):
     """
     Collect the inputs to the form that were passed, and pass them to the edit method on the user being edited. 
@@ -67,32 +239,25 @@ def edit_user(user_id):
     
     return redirect(f'/users/{user_id}')
 
-@app.route('/users/<int:user_id>/delete', methods=['POST'])
+@views.route('/users/<int:user_id>/delete', methods=['POST'])
 def delete_user(user_id):
     """
-    Delete a user from the database from the ID passed.
-    If they have any posts, delete those first to not violate fK restraints.
+    Delete a user from the database from the ID passed, along with their posts.
     Redirect to the user list.
     """
-    user = User.query.get(user_id)
-    for post in user.posts:
-        Post.query.filter_by(id=post.id).delete()
-
-    User.query.filter_by(id=user_id).delete()
-    db.session.commit()
-
+    User.delete_user(user_id)
     return redirect('/users')
 
-@app.route('/users/<int:user_id>/posts/new')
+@views.route('/users/<int:user_id>/posts/new')
 def new_post_form(user_id):
     """
     Show the form to add a new post for a given user.
     """
     user = User.query.get(user_id)
-    all_tags = Tag.query.all()
+    all_tags = tag_registry.all()
     return render_template('new-post.html', user=user, all_tags=all_tags)
 
-@app.route('/users/<int:user_id>/posts/new', methods=['POST'])
+@views.route('/users/<int:user_id>/posts/new', methods=['POST'])
 def add_post(user_id):
     """
     Take the data from the submission of a new post form and make a new record of a Post in the database.
@@ -102,99 +267,165 @@ def add_post(user_id):
     content = request.form['content']
     tags = request.form.getlist('tag')
 
-    Post.commit_new_post(user_id=user_id, title=title, content=content, tags=tags)
+    write(Post.commit_new_post, user_id=user_id, title=title, content=content, tags=tags)
     return redirect(f'/users/{user_id}')
 
-@app.route('/posts/<int:post_id>')
+@views.route('/posts')
+@cached_page
+def show_recent_posts():
+    """
+    Show a page of every user's posts, newest first.
+    With a tags arg like tags=jazz,blues, show only the posts with all of those tags, or any of them if mode=any, newest first by id.
+    400 if the filter is malformed.
+    """
+    query = Post.query.options(db.load_only(*POST_LIST_COLUMNS), db.joinedload(Post.user))
+    if 'tags' not in request.args:
+        page = paginate(query, [Post.created_at, Post.id], descending=True)
+        depends_on('posts')
+        names, match_all = [], True
+    else:
+        try:
+            names, match_all = parse_tag_filter(request.args['tags'], request.args.get('mode', 'all'))
+        except ValueError:
+            abort(400)
+        tags = db.session.query(Tag.id, Tag.post_count).filter(Tag.name.in_(names)).all() if names else []
+        if match_all and len(tags) < len(names):
+            tags = []
+        page = paginate(query.filter(*Post.tag_filter(tags, match_all)), [Post.id], descending=True)
+        depends_on('tags', *(('tag_posts', tag.id) for tag in tags))
+
+    depends_on(*(('post', post.id) for post in page.items), *(('user', post.user_id) for post in page.items))
+    return render_template('posts.html', posts=page.items, page=page, tag_names=names, match_all=match_all)
+
+@views.route('/posts/<int:post_id>')
+@conditional(Post.version)
+@cached_page
 def show_post(post_id):
     """
     Show all of the contents of a post.
     """
-    post = Post.query.get_or_404(post_id)
+    post = Post.get_details_or_404(post_id)
     user = post.user
     tags = post.tags
+    related_posts, related_tags = find_related(post_id, [tag.id for tag in tags])
+    depends_on(('post', post_id), ('user', user.id),
+               *(('tag', tag.id) for tag in tags), *(('tag_posts', tag.id) for tag in tags),
+               *(('post', related.id) for related in related_posts))
     timestamp = post.created_at.strftime("%a %b %d %Y, %I:%M %p")
 
-    return render_template('post.html', post=post, user=user, tags=tags, timestamp=timestamp)
+    return render_template('post.html', post=post, user=user, tags=tags, timestamp=timestamp,
+                           related_posts=related_posts, related_tags=related_tags)
 
-@app.route('/posts/<int:post_id>/edit')
+def find_related(post_id, tag_ids):
+    """
+    The posts sharing the most tags with the post, and the tags most often used alongside its tags, from the related posts index.
+    Costs one query by primary key for the related posts' titles.
+    """
+    links = related_index.links()
+    post_ids = links.related_posts(post_id, tag_ids, RELATED_POSTS)
+    by_id = {post.id: post for post in Post.query.options(db.load_only(*POST_LIST_COLUMNS)).filter(Post.id.in_(post_ids))} if post_ids else {}
+    related_tags = [TagEntry(tag_id, tag_registry.name(tag_id)) for tag_id in links.related_tags(tag_ids, RELATED_TAGS)]
+    return [by_id[related] for related in post_ids if related in by_id], [tag for tag in related_tags if tag.name is not None]
+
+@views.route('/search')
+def search_posts():
+    """
+    Show the posts matching the search terms in the q arg, best matches first, a page at a time.
+    With no terms, just show the search form. 400 for a page past MAX_SEARCH_PAGE.
+    """
+    terms = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    if page > MAX_SEARCH_PAGE:
+        abort(400)
+    per_page = max(1, min(request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int), current_app.config['MAX_PAGE_SIZE']))
+
+    posts, has_next = Post.search(terms, page=page, per_page=per_page) if terms else ([], False)
+    return render_template('search.html', terms=terms, posts=posts, page=page, has_next=has_next and page < MAX_SEARCH_PAGE)
+
+@views.route('/posts/<int:post_id>/edit')
 def edit_post_form(post_id):
     """
     Show the form to edit a post.
-    Pass the post's tags so that they will be pre-checked when the user sees the form.
+    Pass the ids of the post's tags so that they will be pre-checked when the user sees the form.
     """
-    post = Post.query.get_or_404(post_id)
-    all_tags = Tag.query.all()
-    post_tags = post.tags
+    post = Post.get_details_or_404(post_id)
+    all_tags = tag_registry.all()
+    post_tag_ids = {tag.id for tag in post.tags}
 
-    return render_template('post-edit.html', post=post, all_tags=all_tags, post_tags=post_tags)
+    return render_template('post-edit.html', post=post, all_tags=all_tags, post_tag_ids=post_tag_ids)
 
-@app.route('/posts/<int:post_id>/edit', methods=['POST'])
+@views.route('/posts/<int:post_id>/edit', methods=['POST'])
 def edit_post(post_id):
     """
     Take the data from the form for editing a post, and pass it to the method to edit the post.
-    Redirect back to the post details.
+    Redirect back to the post details. 404 if the post doesn't exist, unless the edit was queued.
     """
-    post = Post.query.get(post_id)
     title = request.form['title']
     content = request.form['content']
     tags = request.form.getlist('tag')
 
-    post.edit(title=title, content=content, tags=tags)
+    if write(Post.edit_post, post_id, title=title, content=content, tags=tags) is False:
+        abort(404)
     return redirect(f'/posts/{post_id}')
 
-@app.route('/posts/<int:post_id>/delete', methods=['POST'])
+@views.route('/posts/<int:post_id>/delete', methods=['POST'])
 def delete_post(post_id):
     """
-    First, delete any tag relationships to this post so that there are no FK violations.
-    Then, delete the post and redirect to the user's page.
+    Delete the post, along with its tag relationships.
+    Redirect to the user's page. 404 if the post doesn't exist.
     """
-    post = Post.query.get(post_id)
-    user_id = post.user.id 
-
-    PostTag.query.filter_by(post_id=post_id).delete()
-    Post.query.filter_by(id=post_id).delete()
-    db.session.commit()
+    user_id = Post.delete_post(post_id)
+    if user_id is None:
+        abort(404)
     
     return redirect(f'/users/{user_id}')
 
-@app.route('/tags')
+@views.route('/tags')
+@cached_page
 def show_tags():
     """
-    Show the list of all tags.
+    Show a page of the list of tags, in alphabetical order, or with the most posts first if sort=popular.
     Tags have links to the tag details pages.
     """
-    tags = Tag.query.all()
-    return render_template('tags.html', tags = tags)
-
-@app.route('/tags/new')
+    if request.args.get('sort') == 'popular':
+        page = paginate(Tag.query, [Tag.post_count, Tag.id], descending=True)
+        depends_on('tags', 'tag_counts')
+    else:
+        page = paginate(Tag.query, [Tag.name])
+        depends_on('tags', *(('tag_posts', tag.id) for tag in page.items))
+    return render_template('tags.html', tags = page.items, page = page)
+
+@views.route('/tags/new')
 def add_tag_form():
     """
     Show the form for adding a new tag.
     """
     return render_template('new-tag.html')
 
-@app.route('/tags/new', methods=['POST'])
+@views.route('/tags/new', methods=['POST'])
 def add_tag():
     """
     Process a new tag submitted from the form and commit it to the database.
     Redirect to the list of tags.
     """
     name = request.form['name']
-    Tag.commit_new_tag(name)
+    write(Tag.commit_new_tag, name)
     return redirect('/tags')
 
-@app.route('/tags/<int:tag_id>')
+@views.route('/tags/<int:tag_id>')
+@conditional(Tag.version)
+@cached_page
 def show_tag_details(tag_id):
     """
-    Show the posts associated with a given tag, if there are any.
+    Show a page of the posts associated with a given tag, if there are any.
     This route also allows the user to edit or delete a tag.
     """
     tag = Tag.query.get_or_404(tag_id)
-    posts = tag.posts
-    return render_template('tag-details.html', tag = tag, posts = posts)
+    page = paginate(Post.query.options(db.load_only(*POST_LIST_COLUMNS)).join(PostTag).filter(PostTag.tag_id == tag_id), [Post.id])
+    depends_on(('tag', tag_id), ('tag_posts', tag_id), *(('post', post.id) for post in page.items))
+    return render_template('tag-details.html', tag = tag, posts = page.items, page = page)
 
-@app.route('/tags/<int:tag_id>/edit')
+@views.route('/tags/<int:tag_id>/edit')
 def edit_tag_form(tag_id):
     """
     Show the form for editing the name of a tag, if the tag exists.
@@ -202,7 +433,7 @@ def edit_tag_form(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     return render_template('tag-edit.html', tag=tag)
 
-@app.route('/tags/<int:tag_id>/edit', methods=['POST'])
+@views.route('/tags/<int:tag_id>/edit', methods=['POST'])
 def edit_tag(tag_id):
     """
     Handle the submission of the form for editing a tag, and commit changes to the db.
@@ -214,14 +445,11 @@ def edit_tag(tag_id):
     tag.edit(name)
     return redirect(f'/tags/{tag_id}')
 
-@app.route('/tags/<int:tag_id>/delete', methods=['POST'])
+@views.route('/tags/<int:tag_id>/delete', methods=['POST'])
 def delete_tag(tag_id):
     """
-    Delete the tag with the ID in the URL.
-    First delete any tag/post relationships so you don't violate FK restraints.
+    Delete the tag with the ID in the URL, along with its tag/post relationships.
+    Redirect to the list of tags.
     """
-    PostTag.query.filter_by(tag_id=tag_id).delete()
-    Tag.query.filter_by(id=tag_id).delete()
-    db.session.commit()
-
+    Tag.delete_tag(tag_id)
     return redirect('/tags')
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""
+An asyncio serving mode for the read-only pages: the user list, user details, recent posts, post, tag list and tag details pages.
+They render the same templates as app.py, with the same keyset pagination and conditional request handling.
+Queries run on SQLAlchemy's asyncio engine (asyncpg on Postgres, aiosqlite on SQLite). A worker can serve
+many page views at once, because a view waiting on the database doesn't hold a thread.
+
+    hypercorn 'async_app:create_async_app()'
+
+Have the proxy send GET requests for these pages here, and everything else (forms, writes, search, the API) to the WSGI app.
+Settings come from the same environment as create_app (see config.py), including the read replicas.
+Posts' content is deferred (see models.py), and lazy loads can't run here, so every query says which columns it needs.
+There's no page cache here, since writes happen in the WSGI processes, which can't invalidate this process's pages.
+"""
+import random
+import time
+from functools import wraps
+from quart import Quart, Blueprint, abort, current_app, g, make_response, redirect, render_template, request
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, load_only, selectinload, undefer
+from werkzeug.sansio.http import is_resource_modified
+from app import version_validators, parse_tag_filter, RELATED_POSTS, RELATED_TAGS
+from config import config_from_env, async_engine_options
+from models import User, Post, Tag, PostTag, POST_LIST_COLUMNS, related_index
+from registry import TagEntry
+from pagination import keyset_query, page_from_rows
+from routing import STICKY_COOKIE
+import fragments
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+views = Blueprint('blogly', __name__)
+
+def create_async_app(config=None):
+    """
+    Build the async app, with settings from the environment overridden by the config dict passed.
+    The engines connect on first use, inside the server's event loop.
+    """
+    app = Quart(__name__)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+
+    options = async_engine_options(app.config)
+    app.extensions['async_engines'] = {
+        'primary': create_async_engine(async_url(app.config['SQLALCHEMY_DATABASE_URI']), **options),
+        'replicas': [create_async_engine(async_url(uri), **options) for uri in app.config['REPLICA_DATABASE_URIS']]
+    }
+
+    app.register_blueprint(views)
+    fragments.init_app(app)
+    app.before_request(open_session)
+    app.teardown_request(close_session)
+    app.after_serving(dispose_engines)
+    return app
+
+def async_url(url):
+    """The same database URL, with the asyncio driver for that database."""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+def read_engine():
+    """A random replica to read from, or the primary if there are none or the client wrote something moments ago."""
+    engines = current_app.extensions['async_engines']
+    if engines['replicas'] and request.cookies.get(STICKY_COOKIE, type=float, default=0) <= time.time():
+        return random.choice(engines['replicas'])
+    return engines['primary']
+
+async def open_session():
+    g.session = AsyncSession(read_engine(), expire_on_commit=False)
+
+async def close_session(exc):
+    if 'session' in g:
+        await g.session.close()
+
+async def dispose_engines():
+    engines = current_app.extensions['async_engines']
+    for engine in [engines['primary'], *engines['replicas']]:
+        await engine.dispose()
+
+async def get_or_404(query):
+    """Run a select() of a single model and return the first one, or 404 if there isn't one."""
+    obj = (await g.session.execute(query)).scalars().first()
+    if obj is None:
+        abort(404)
+    return obj
+
+async def paginate(query, columns, descending=False):
+    """
+    Get the page of the select() asked for by the request's after/before cursors and per_page args, like paginate in app.py.
+    400 if the cursor is malformed.
+    """
+    per_page = request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+    after, before = request.args.get('after'), request.args.get('before')
+
+    try:
+        query = keyset_query(query, columns, after=after, before=before, per_page=per_page, descending=descending)
+    except ValueError:
+        abort(400)
+
+    rows = (await g.session.execute(query)).scalars().all()
+    return page_from_rows(rows, columns, after=after, before=before, per_page=per_page)
+
+def conditional(version_select):
+    """
+    Make a details view answer conditional requests, like conditional in app.py.
+    version_select is called with the view's arguments and returns the select() behind the model's version().
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            stamp = (await g.session.execute(version_select(*args, **kwargs))).first()
+            if stamp is None:
+                abort(404)
+
+            etag, last_modified = version_validators(request.full_path, stamp)
+            if is_resource_modified(http_if_none_match=request.headers.get('If-None-Match'),
+                                    http_if_modified_since=request.headers.get('If-Modified-Since'),
+                                    etag=etag, last_modified=last_modified):
+                response = await make_response(await view(*args, **kwargs))
+            else:
+                response = await make_response('', 304)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+@views.route('/')
+async def redirect_to_users():
+    "Redirect user from the root directory to the users list"
+    return redirect('/users')
+
+@views.route('/users')
+async def show_users():
+    """Show a page of the list of users, in the order they signed up, or with the most posts first if sort=popular"""
+    if request.args.get('sort') == 'popular':
+        page = await paginate(select(User), [User.post_count, User.id], descending=True)
+    else:
+        page = await paginate(select(User), [User.id])
+    return await render_template('users.html', users=page.items, page=page)
+
+@views.route('/users/<int:user_id>')
+@conditional(User.version_select)
+async def show_user_details(user_id):
+    """Show the details page for the given user, with a page of their posts, newest first. 404 if that user is not found."""
+    user = await get_or_404(select(User).where(User.id == user_id))
+    page = await paginate(select(Post).options(load_only(*POST_LIST_COLUMNS)).where(Post.user_id == user_id),
+                          [Post.created_at, Post.id], descending=True)
+    return await render_template('user-details.html', user=user, posts=page.items, page=page)
+
+@views.route('/posts')
+async def show_recent_posts():
+    """Show a page of every user's posts, newest first, or of the posts with all or any of some tags, like show_recent_posts in app.py."""
+    query = select(Post).options(load_only(*POST_LIST_COLUMNS), joinedload(Post.user))
+    if 'tags' not in request.args:
+        page = await paginate(query, [Post.created_at, Post.id], descending=True)
+        names, match_all = [], True
+    else:
+        try:
+            names, match_all = parse_tag_filter(request.args['tags'], request.args.get('mode', 'all'))
+        except ValueError:
+            abort(400)
+        tags = (await g.session.execute(select(Tag.id, Tag.post_count).where(Tag.name.in_(names)))).all() if names else []
+        if match_all and len(tags) < len(names):
+            tags = []
+        page = await paginate(query.where(*Post.tag_filter(tags, match_all)), [Post.id], descending=True)
+    return await render_template('posts.html', posts=page.items, page=page, tag_names=names, match_all=match_all)
+
+@views.route('/posts/<int:post_id>')
+@conditional(Post.version_select)
+async def show_post(post_id):
+    """Show all of the contents of a post."""
+    post = await get_or_404(select(Post).options(undefer(Post.content), joinedload(Post.user), selectinload(Post.tags)).where(Post.id == post_id))
+    related_posts, related_tags = await find_related(post_id, [tag.id for tag in post.tags])
+    timestamp = post.created_at.strftime("%a %b %d %Y, %I:%M %p")
+    return await render_template('post.html', post=post, user=post.user, tags=post.tags, timestamp=timestamp,
+                                 related_posts=related_posts, related_tags=related_tags)
+
+async def find_related(post_id, tag_ids):
+    """
+    The related posts and tags, like find_related in app.py.
+    This process never writes, so its copy of the related posts index is only brought up to date by reloading it.
+    """
+    async def load():
+        return await g.session.execute(select(PostTag.post_id, PostTag.tag_id).order_by(PostTag.post_id))
+
+    links = await related_index.links_async(load)
+
+    post_ids = links.related_posts(post_id, tag_ids, RELATED_POSTS)
+    tag_ids = links.related_tags(tag_ids, RELATED_TAGS)
+    posts = (await g.session.execute(select(Post).options(load_only(*POST_LIST_COLUMNS)).where(Post.id.in_(post_ids)))).scalars() if post_ids else []
+    names = dict((await g.session.execute(select(Tag.id, Tag.name).where(Tag.id.in_(tag_ids)))).all()) if tag_ids else {}
+    by_id = {post.id: post for post in posts}
+    return [by_id[related] for related in post_ids if related in by_id], [TagEntry(tag_id, names[tag_id]) for tag_id in tag_ids if tag_id in names]
+
+@views.route('/tags')
+async def show_tags():
+    """Show a page of the list of tags, in alphabetical order, or with the most posts first if sort=popular."""
+    if request.args.get('sort') == 'popular':
+        page = await paginate(select(Tag), [Tag.post_count, Tag.id], descending=True)
+    else:
+        page = await paginate(select(Tag), [Tag.name])
+    return await render_template('tags.html', tags=page.items, page=page)
+
+@views.route('/tags/<int:tag_id>')
+@conditional(Tag.version_select)
+async def show_tag_details(tag_id):
+    """Show a page of the posts associated with a given tag."""
+    tag = await get_or_404(select(Tag).where(Tag.id == tag_id))
+    page = await paginate(select(Post).options(load_only(*POST_LIST_COLUMNS)).join(PostTag).where(PostTag.tag_id == tag_id), [Post.id])
+    return await render_template('tag-details.html', tag=tag, posts=page.items, page=page)
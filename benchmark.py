@@ -0,0 +1,441 @@
+"""
+Benchmark every route (the pages, the JSON API and /metrics) and model write path against seeded datasets of several sizes.
+
+    python benchmark.py --sizes 100,1000,10000 --output before.json
+    python benchmark.py --sizes 100,1000,10000 --output after.json
+    python benchmark.py --compare before.json after.json
+
+For each size, a fresh database is seeded with seed.py's bulk seeder (size users, --posts-per-user posts each),
+then every case is run --repeat times through the Flask test client or by calling the model method directly.
+We record the p50 and p99 latency, the SQL statements each call runs, and the peak memory Python allocated during one call.
+Read routes are measured both cold (page cache cleared before each call) and warm (served from the cache).
+With --concurrency 1,10,50 the read pages are also served under load, with the page cache off,
+by the sync app from that many threads and by async_app.py from that many concurrent tasks, and we record the throughput of each.
+With --render 1000, instead time rendering a list of that many rows, inline in a loop the way the list templates used to,
+and from cached fragments, cold and warm, and report the time per row.
+--compare exits with status 1 if any case got slower than --threshold times, or runs more statements, than before.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from itertools import count
+from sqlalchemy import event
+from app import create_app
+from cache import page_cache
+from fragments import fragment_cache
+from models import db, User, Post, Tag
+from seed import seed_bulk
+
+# setup() is called untimed before each run, and whatever it returns is passed to run()
+Case = namedtuple('Case', ['name', 'setup', 'run'])
+
+unique = count()
+
+def no_setup():
+    return None
+
+def get(app, url):
+    """A run() that GETs the URL and fails loudly on anything but a 200."""
+    def run(_):
+        with app.test_client() as client:
+            response = client.get(url)
+            response.get_data()
+            assert response.status_code == 200, f'GET {url} returned {response.status_code}'
+    return run
+
+def post(app, url_for, data_for=lambda target: {}):
+    """A run() that POSTs to the URL made from setup()'s return value, and expects a redirect."""
+    def run(target):
+        with app.test_client() as client:
+            url = url_for(target)
+            response = client.post(url, data=data_for(target))
+            assert response.status_code == 302, f'POST {url} returned {response.status_code}'
+    return run
+
+def new_user():
+    User.commit_new_user(first=f'Bench{next(unique)}', last='User', image='')
+    return db.session.query(db.func.max(User.id)).scalar()
+
+def new_post(user_id, tag_ids):
+    return Post.commit_new_post(user_id=user_id, title=f'Bench {next(unique)}', content='Benchmarking.', tags=tag_ids).id
+
+def new_tag():
+    Tag.commit_new_tag(f'bench-{next(unique)}')
+    return db.session.query(db.func.max(Tag.id)).scalar()
+
+def build_cases(app, user_id, post_id, tag_id, tag_ids, tag_names):
+    """
+    Every route in app.py and api.py, /metrics, and every model write path, against rows that exist in the seeded dataset.
+    tag_names are the names of two seeded tags, for filtering /posts by.
+    """
+    tag_filter = ','.join(tag_names)
+    reads = [
+        ('GET /users', '/users'),
+        ('GET /users?sort=popular', '/users?sort=popular'),
+        ('GET /users/<id>', f'/users/{user_id}'),
+        ('GET /posts', '/posts'),
+        ('GET /posts?tags=&mode=all', f'/posts?tags={tag_filter}&mode=all'),
+        ('GET /posts?tags=&mode=any', f'/posts?tags={tag_filter}&mode=any'),
+        ('GET /posts/<id>', f'/posts/{post_id}'),
+        ('GET /tags', '/tags'),
+        ('GET /tags?sort=popular', '/tags?sort=popular'),
+        ('GET /tags/<id>', f'/tags/{tag_id}')
+    ]
+
+    cases = []
+    for name, url in reads:
+        cases.append(Case(f'{name} [cold]', page_cache.clear, get(app, url)))
+        cases.append(Case(f'{name} [cached]', no_setup, get(app, url)))
+
+    cases += [
+        Case('GET /', no_setup, lambda _: app.test_client().get('/')),
+        Case('GET /users/new', no_setup, get(app, '/users/new')),
+        Case('GET /users/<id>/edit', no_setup, get(app, f'/users/{user_id}/edit')),
+        Case('GET /users/<id>/posts/new', no_setup, get(app, f'/users/{user_id}/posts/new')),
+        Case('GET /posts/<id>/edit', no_setup, get(app, f'/posts/{post_id}/edit')),
+        Case('GET /search', no_setup, get(app, '/search?q=coffee+garden')),
+        Case('GET /tags/new', no_setup, get(app, '/tags/new')),
+        Case('GET /tags/<id>/edit', no_setup, get(app, f'/tags/{tag_id}/edit')),
+        Case('GET /cache/stats', no_setup, get(app, '/cache/stats')),
+        Case('GET /metrics', no_setup, get(app, '/metrics')),
+        Case('GET /api/users', no_setup, get(app, '/api/users')),
+        Case('GET /api/users/<id>', no_setup, get(app, f'/api/users/{user_id}')),
+        Case('GET /api/users/<id>/posts', no_setup, get(app, f'/api/users/{user_id}/posts')),
+        Case('GET /api/posts', no_setup, get(app, '/api/posts')),
+        Case('GET /api/posts/<id>', no_setup, get(app, f'/api/posts/{post_id}')),
+        Case('GET /api/tags', no_setup, get(app, '/api/tags')),
+        Case('GET /api/tags/autocomplete', no_setup, get(app, f'/api/tags/autocomplete?q={tag_names[0][:2]}')),
+        Case('GET /api/tags/<id>', no_setup, get(app, f'/api/tags/{tag_id}')),
+        Case('GET /api/tags/<id>/posts', no_setup, get(app, f'/api/tags/{tag_id}/posts')),
+
+        Case('POST /users/new', no_setup, post(app, lambda _: '/users/new',
+            lambda _: {'first': f'Bench{next(unique)}', 'last': 'User', 'image': ''})),
+        Case('POST /users/<id>/edit', no_setup, post(app, lambda _: f'/users/{user_id}/edit',
+            lambda _: {'first': f'Bench{next(unique)}', 'last': '', 'image': ''})),
+        Case('POST /users/<id>/delete', new_user, post(app, lambda target: f'/users/{target}/delete')),
+        Case('POST /users/<id>/posts/new', no_setup, post(app, lambda _: f'/users/{user_id}/posts/new',
+            lambda _: {'title': f'Bench {next(unique)}', 'content': 'Benchmarking.', 'tag': tag_ids})),
+        Case('POST /posts/<id>/edit', no_setup, post(app, lambda _: f'/posts/{post_id}/edit',
+            lambda _: {'title': f'Bench {next(unique)}', 'content': 'Benchmarking.', 'tag': tag_ids[next(unique) % 2::2]})),
+        Case('POST /posts/<id>/delete', lambda: new_post(user_id, tag_ids), post(app, lambda target: f'/posts/{target}/delete')),
+        Case('POST /tags/new', no_setup, post(app, lambda _: '/tags/new', lambda _: {'name': f'bench-{next(unique)}'})),
+        Case('POST /tags/<id>/edit', new_tag, post(app, lambda target: f'/tags/{target}/edit',
+            lambda _: {'name': f'bench-{next(unique)}'})),
+        Case('POST /tags/<id>/delete', new_tag, post(app, lambda target: f'/tags/{target}/delete')),
+
+        Case('User.commit_new_user', no_setup,
+            lambda _: User.commit_new_user(first=f'Bench{next(unique)}', last='User', image='')),
+        Case('User.edit', no_setup,
+            lambda _: User.query.get(user_id).edit(first=f'Bench{next(unique)}', last='', image='')),
+        Case('User.delete_user', new_user, User.delete_user),
+        Case('Post.commit_new_post', no_setup, lambda _: new_post(user_id, tag_ids)),
+        Case('Post.commit_new_posts x100', no_setup, lambda _: Post.commit_new_posts([
+            {'user_id': user_id, 'title': f'Bench {next(unique)}', 'content': 'Benchmarking.', 'tags': tag_ids}
+            for _ in range(100)
+        ])),
+        Case('Post.edit', no_setup,
+            lambda _: Post.query.get(post_id).edit(title=f'Bench {next(unique)}', content='Benchmarking.',
+                                       tags=tag_ids[next(unique) % 2::2])),
+        Case('Post.delete_post', lambda: new_post(user_id, tag_ids), Post.delete_post),
+        Case('Post.search', no_setup, lambda _: Post.search('coffee garden')),
+        Case('Tag.commit_new_tag', no_setup, lambda _: Tag.commit_new_tag(f'bench-{next(unique)}')),
+        Case('Tag.edit', new_tag, lambda target: Tag.query.get(target).edit(f'bench-{next(unique)}')),
+        Case('Tag.delete_tag', new_tag, Tag.delete_tag)
+    ]
+    return cases
+
+def percentile(values, pct):
+    """The pct percentile of the values, by the nearest-rank method."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def measure(case, repeat):
+    """Run a case repeat times, then once more under tracemalloc, and summarize it."""
+    statements = []
+    on_execute = lambda *args: statements.append(1)
+
+    timings, counts = [], []
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        for _ in range(repeat):
+            target = case.setup()
+            db.session.remove()
+            statements.clear()
+
+            started = time.perf_counter()
+            case.run(target)
+            timings.append(time.perf_counter() - started)
+            counts.append(len(statements))
+            db.session.remove()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+    target = case.setup()
+    db.session.remove()
+    tracemalloc.start()
+    try:
+        case.run(target)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        db.session.remove()
+
+    return {
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(statistics.mean(timings) * 1000, 3),
+        'statements': statistics.median(counts),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+def read_urls(user_id, post_id, tag_id):
+    """The pages async_app.py serves, for the concurrency benchmark."""
+    return [
+        ('GET /users', '/users'),
+        ('GET /users/<id>', f'/users/{user_id}'),
+        ('GET /posts', '/posts'),
+        ('GET /posts/<id>', f'/posts/{post_id}'),
+        ('GET /tags', '/tags'),
+        ('GET /tags/<id>', f'/tags/{tag_id}')
+    ]
+
+def summarize_load(elapsed, latencies):
+    return {
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3)
+    }
+
+def sync_load(app, url, concurrency, total):
+    """GET the URL total times from concurrency threads through the WSGI app."""
+    def one(_):
+        started = time.perf_counter()
+        with app.test_client() as client:
+            response = client.get(url)
+            response.get_data()
+        assert response.status_code == 200, f'GET {url} returned {response.status_code}'
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, range(total)))
+    return summarize_load(time.perf_counter() - started, latencies)
+
+async def async_load(client, url, concurrency, total):
+    """GET the URL total times, concurrency at a time, through the async app."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with limit:
+            started = time.perf_counter()
+            response = await client.get(url)
+            await response.get_data()
+            assert response.status_code == 200, f'GET {url} returned {response.status_code}'
+            return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(one() for _ in range(total)))
+    return summarize_load(time.perf_counter() - started, latencies)
+
+def run_concurrency(size, database_url, levels, total):
+    """
+    Serve the read pages under load from the sync app and the async app, against the database run_size seeded.
+    The page cache is off so both apps hit the database on every request.
+    """
+    from async_app import create_async_app
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url, 'SQLALCHEMY_ECHO': False, 'TESTING': True, 'PAGE_CACHE_SIZE': 0})
+    user_id = size // 2 or 1
+    post_id = db.session.query(db.func.min(Post.id)).filter(Post.user_id == user_id).scalar()
+    db.session.remove()
+    urls = read_urls(user_id, post_id, 1)
+
+    async def run_async():
+        async_app = create_async_app({'SQLALCHEMY_DATABASE_URI': database_url})
+        async with async_app.test_app() as test_app:
+            client = test_app.test_client()
+            return {
+                (name, level): await async_load(client, url, level, total)
+                for name, url in urls for level in levels
+            }
+    async_results = asyncio.run(run_async())
+
+    results = {}
+    for name, url in urls:
+        for level in levels:
+            for mode, result in (('sync', sync_load(app, url, level, total)), ('async', async_results[name, level])):
+                results[f'{name} x{level} [{mode}]'] = result
+                print(f'{size:>8} {name:<20} x{level:<4} {mode:<5} {result["requests_per_s"]:>9.1f} req/s  '
+                      f'p50 {result["p50_ms"]:>9.2f}ms  p99 {result["p99_ms"]:>9.2f}ms', file=sys.stderr)
+    return results
+
+# The user list's rows as they were rendered before fragments, and as they are now
+INLINE_USER_ROWS = """{% for user in users %}
+    <li><a href="/users/{{user.id}}">
+        {{user.first_name}}{% if user.last_name %} {{user.last_name}}{% endif %}
+    </a> <small class="text-muted">{{user.post_count}} post{% if user.post_count != 1 %}s{% endif %}</small></li>
+    {% endfor %}"""
+
+FRAGMENT_USER_ROWS = """{{user_rows(users)}}"""
+
+def run_render(rows, repeat):
+    """Time rendering rows users inline and from fragments, and return the microseconds per row for each."""
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'TESTING': True})
+    users = [
+        SimpleNamespace(id=n, first_name=f'First{n}', last_name=f'Last{n}' if n % 3 else None, post_count=n % 7)
+        for n in range(1, rows + 1)
+    ]
+    variants = [
+        ('inline', no_setup, app.jinja_env.from_string(INLINE_USER_ROWS)),
+        ('fragments [cold]', fragment_cache.clear, app.jinja_env.from_string(FRAGMENT_USER_ROWS)),
+        ('fragments [warm]', no_setup, app.jinja_env.from_string(FRAGMENT_USER_ROWS))
+    ]
+
+    results = {}
+    for name, setup, template in variants:
+        timings = []
+        for _ in range(repeat):
+            setup()
+            started = time.perf_counter()
+            template.render(users=users)
+            timings.append(time.perf_counter() - started)
+        results[name] = {
+            'p50_us_per_row': round(percentile(timings, 50) / rows * 10 ** 6, 3),
+            'p99_us_per_row': round(percentile(timings, 99) / rows * 10 ** 6, 3)
+        }
+        print(f'{rows:>8} rows {name:<20} p50 {results[name]["p50_us_per_row"]:>8.2f}us/row  '
+              f'p99 {results[name]["p99_us_per_row"]:>8.2f}us/row', file=sys.stderr)
+    return results
+
+def run_size(size, database_url, posts_per_user, repeat, only):
+    """
+    Seed a fresh database with size users and benchmark every case against it.
+    Returns the results and the name of the database dialect.
+    """
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url, 'SQLALCHEMY_ECHO': False, 'TESTING': True})
+    db.session.remove()
+    db.drop_all()
+    seed_bulk(users=size, posts_per_user=posts_per_user, tags=max(10, size // 10), seed=0)
+    page_cache.clear()
+
+    user_id = size // 2 or 1
+    post_id = db.session.query(db.func.min(Post.id)).filter(Post.user_id == user_id).scalar()
+    tag_id = 1
+    tag_ids = [str(tag) for tag in range(1, 6)]
+    tag_names = [name for (name,) in db.session.query(Tag.name).filter(Tag.id.in_([1, 2])).order_by(Tag.id)]
+    db.session.remove()
+
+    results = {}
+    for case in build_cases(app, user_id, post_id, tag_id, tag_ids, tag_names):
+        if only and only not in case.name:
+            continue
+        results[case.name] = measure(case, repeat)
+        print(f'{size:>8} {case.name:<40} p50 {results[case.name]["p50_ms"]:>9.2f}ms  '
+              f'p99 {results[case.name]["p99_ms"]:>9.2f}ms  {results[case.name]["statements"]:>5} stmts  '
+              f'{results[case.name]["peak_kb"]:>9.1f}KB', file=sys.stderr)
+    return results, db.engine.dialect.name
+
+def git_commit():
+    """The commit being benchmarked, if we're in a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(before_path, after_path, threshold):
+    """Print how each case changed between two result files, and return the regressions."""
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file)['results'], json.load(after_file)['results']
+
+    regressions = []
+    for size, cases in after.items():
+        for name, new in cases.items():
+            old = before.get(size, {}).get(name)
+            if old is None:
+                continue
+
+            ratio = new['p50_ms'] / old['p50_ms'] if old['p50_ms'] else 1
+            slower = ratio > threshold
+            more_statements = new['statements'] > old['statements']
+            flag = ' REGRESSION' if slower or more_statements else ''
+            print(f'{size:>8} {name:<40} p50 {old["p50_ms"]:>9.2f} -> {new["p50_ms"]:>9.2f}ms ({ratio:4.2f}x)  '
+                  f'stmts {old["statements"]:>5} -> {new["statements"]:<5}{flag}')
+            if flag:
+                regressions.append((size, name))
+    return regressions
+
+def write_report(report, path):
+    """Write the report as JSON to the file at path, or to stdout if there isn't one."""
+    if path:
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark blogly routes and model write paths.')
+    parser.add_argument('--sizes', default='100,1000,10000', help='comma separated numbers of users to seed')
+    parser.add_argument('--posts-per-user', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=30, help='timed calls per case')
+    parser.add_argument('--only', help='only run cases whose name contains this')
+    parser.add_argument('--database-url', help='database to benchmark against, with {size} replaced by the size '
+                                               '(defaults to a SQLite file per size in a temporary directory)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=1.25, help='p50 slowdown that counts as a regression')
+    parser.add_argument('--concurrency', help='comma separated numbers of concurrent requests to compare the sync and async apps at')
+    parser.add_argument('--requests', type=int, default=200, help='requests per page at each concurrency level')
+    parser.add_argument('--render', type=int, metavar='ROWS', help='only time rendering a list of this many rows')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        print(f'{len(regressions)} regressions')
+        return 1 if regressions else 0
+
+    if args.render:
+        report = {'meta': {'commit': git_commit(), 'python': platform.python_version(), 'repeat': args.repeat},
+                  'render': run_render(args.render, args.repeat)}
+        write_report(report, args.output)
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url_template = args.database_url or 'sqlite:///' + os.path.join(tmp, 'bench_{size}.db')
+        results, concurrency = {}, {}
+        for size in (int(float(size)) for size in args.sizes.split(',')):
+            database_url = url_template.format(size=size)
+            results[str(size)], database = run_size(size, database_url, args.posts_per_user, args.repeat, args.only)
+            if args.concurrency:
+                levels = [int(level) for level in args.concurrency.split(',')]
+                concurrency[str(size)] = run_concurrency(size, database_url, levels, args.requests)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'database': database,
+            'posts_per_user': args.posts_per_user,
+            'repeat': args.repeat,
+            'run_at': datetime.utcnow().isoformat()
+        },
+        'results': results,
+        'concurrency': concurrency
+    }
+    write_report(report, args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+class PageCache:
+    """
+    An in-process LRU cache for rendered pages, with a maximum size and a time to live for each entry.
+    Each entry is stored with the dependency keys it was built from, like ('user', 1) or 'tags',
+    so the write paths can invalidate exactly the pages that showed the rows they changed.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, max_size, ttl):
+        """Change the size and TTL limits. Clears the cache."""
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+        self.clear()
+
+    def get(self, key):
+        """Return the cached value for the key, or None if it isn't cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, depends_on=(), generation=None):
+        """
+        Cache a value, evicting the least recently used entries if we're over the size limit.
+        Pass the cache's generation from before the value was built, and the value won't be cached
+        if anything was invalidated in the meantime, since it may have been built from stale rows.
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            deps = frozenset(depends_on)
+            self._entries[key] = (value, time.monotonic() + self.ttl, deps)
+            for dep in deps:
+                self._dependents.setdefault(dep, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, *deps):
+        """Drop every entry that was built from any of the dependency keys passed."""
+        with self._lock:
+            self.generation += 1
+            for dep in deps:
+                for key in self._dependents.pop(dep, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry. The hit and miss counters are kept."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._dependents.clear()
+
+    def stats(self):
+        """Return the cache's counters and current size as a dict."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl
+            }
+
+    def _remove(self, key):
+        """Remove an entry and its reverse dependency links. Caller must hold the lock."""
+        _, _, deps = self._entries.pop(key)
+        for dep in deps:
+            keys = self._dependents.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[dep]
+
+page_cache = PageCache()
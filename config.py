@@ -0,0 +1,138 @@
+"""
+Settings for create_app, read from the environment so each deployment can be tuned without code changes.
+
+DATABASE_URL              the database to use (postgres:// URLs from hosting providers are accepted too)
+DATABASE_REPLICA_URLS     comma separated read replicas of DATABASE_URL, for GET requests to read from
+REPLICA_STICKY_SECONDS    how long a client reads from the primary after it writes, to cover the replicas' lag
+SECRET_KEY                Flask's secret key
+DB_POOL_SIZE              connections each worker process keeps open
+DB_MAX_OVERFLOW           extra connections a worker may open under load, closed again when they're returned
+DB_MAX_CONNECTIONS        the database's connection budget for this app; if set, and DB_POOL_SIZE isn't,
+                          it's split evenly between the WEB_CONCURRENCY worker processes with no overflow
+DB_POOL_TIMEOUT           seconds to wait for a free connection before giving up
+DB_POOL_RECYCLE           seconds after which a connection is replaced, to stay under server and proxy idle timeouts
+DB_POOL_PRE_PING          1 (the default) to check each connection as it's taken from the pool and replace it if it's gone,
+                          so a database failover or restart costs a round trip instead of failed requests; 0 to skip the check
+DB_CONNECT_TIMEOUT        seconds to wait when opening a new connection (Postgres only)
+DB_STATEMENT_TIMEOUT_MS   cancel any statement that runs longer than this (Postgres only, unlimited if unset or 0)
+RELATED_INDEX_TTL         seconds between reloads of the related posts index, which reads the whole posts_tags table
+TEMPLATE_CACHE_DIR        where compiled templates are cached between processes (the system temp directory by default)
+FRAGMENT_CACHE_SIZE       how many rendered list rows to keep in memory
+WRITE_BEHIND              1 to queue form submissions and commit them in batches (see writebehind.py for what that risks)
+WRITE_BATCH_SIZE          the most queued writes committed in one transaction
+WRITE_FLUSH_MS            how long a batch waits for more writes after its first
+WRITE_QUEUE_SIZE          how many writes may be waiting before submissions are held back
+WRITE_QUEUE_TIMEOUT_MS    how long a submission waits for room in a full queue before the request gets a 503
+METRICS_DIR               a directory the worker processes share their metrics through, so /metrics counts them all
+                          (see instrumentation.py); without it, each scrape sees only the worker that served it
+"""
+import os
+
+# SQLAlchemy's own defaults, per process
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+def env_int(environ, name, default=None):
+    """Read an integer from the environment, or the default if it isn't set."""
+    value = environ.get(name, '').strip()
+    return int(value) if value else default
+
+def database_url(environ):
+    """The database URL, with the postgres:// scheme SQLAlchemy no longer accepts rewritten."""
+    return normalize_url(environ.get('DATABASE_URL', 'postgresql:///blogly'))
+
+def replica_urls(environ):
+    """The read replica URLs, if there are any."""
+    return [normalize_url(url.strip()) for url in environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+def normalize_url(url):
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def pool_size(environ):
+    """
+    Work out (pool_size, max_overflow) for one worker process.
+    Every gunicorn worker gets its own pool, so a fixed budget of connections has to be divided between them.
+    """
+    size = env_int(environ, 'DB_POOL_SIZE')
+    overflow = env_int(environ, 'DB_MAX_OVERFLOW')
+    budget = env_int(environ, 'DB_MAX_CONNECTIONS')
+
+    if size is None and budget is not None:
+        workers = max(1, env_int(environ, 'WEB_CONCURRENCY', 1))
+        size = max(1, budget // workers)
+        overflow = 0 if overflow is None else overflow
+
+    return (DEFAULT_POOL_SIZE if size is None else size,
+            DEFAULT_MAX_OVERFLOW if overflow is None else overflow)
+
+def config_from_env(environ=os.environ):
+    """Build the app's config dict from environment variables."""
+    size, overflow = pool_size(environ)
+    return {
+        'SECRET_KEY': environ.get('SECRET_KEY', 'blogly4567'),
+        'SQLALCHEMY_DATABASE_URI': database_url(environ),
+        'REPLICA_DATABASE_URIS': replica_urls(environ),
+        'REPLICA_STICKY_SECONDS': env_int(environ, 'REPLICA_STICKY_SECONDS', 5),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'PAGE_SIZE': 50,
+        'MAX_PAGE_SIZE': 500,
+        'PAGE_CACHE_SIZE': 1024,
+        'PAGE_CACHE_TTL': 60,
+        'SLOW_QUERY_MS': 100,
+        'TAG_REGISTRY_TTL': 60,
+        'RELATED_INDEX_TTL': env_int(environ, 'RELATED_INDEX_TTL', 600),
+        'TEMPLATE_CACHE_DIR': environ.get('TEMPLATE_CACHE_DIR'),
+        'FRAGMENT_CACHE_SIZE': env_int(environ, 'FRAGMENT_CACHE_SIZE', 10000),
+        'WRITE_BEHIND': bool(env_int(environ, 'WRITE_BEHIND', 0)),
+        'WRITE_BATCH_SIZE': env_int(environ, 'WRITE_BATCH_SIZE', 100),
+        'WRITE_FLUSH_MS': env_int(environ, 'WRITE_FLUSH_MS', 50),
+        'WRITE_QUEUE_SIZE': env_int(environ, 'WRITE_QUEUE_SIZE', 1000),
+        'WRITE_QUEUE_TIMEOUT_MS': env_int(environ, 'WRITE_QUEUE_TIMEOUT_MS', 1000),
+        'METRICS_DIR': environ.get('METRICS_DIR') or None,
+        'DB_POOL_SIZE': size,
+        'DB_MAX_OVERFLOW': overflow,
+        'DB_POOL_TIMEOUT': env_int(environ, 'DB_POOL_TIMEOUT', 10),
+        'DB_POOL_RECYCLE': env_int(environ, 'DB_POOL_RECYCLE', 1800),
+        'DB_POOL_PRE_PING': bool(env_int(environ, 'DB_POOL_PRE_PING', 1)),
+        'DB_CONNECT_TIMEOUT': env_int(environ, 'DB_CONNECT_TIMEOUT', 5),
+        'DB_STATEMENT_TIMEOUT_MS': env_int(environ, 'DB_STATEMENT_TIMEOUT_MS', 0)
+    }
+
+def engine_options(config):
+    """
+    Turn the DB_* settings into create_engine() arguments, for the primary and the replicas alike.
+    SQLite doesn't use a queue pool or understand the Postgres connection options, so it gets the defaults.
+    """
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING']
+    }
+
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        connect_args = {'connect_timeout': config['DB_CONNECT_TIMEOUT']}
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['options'] = f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"
+        options['connect_args'] = connect_args
+
+    return options
+
+def async_engine_options(config):
+    """
+    The same settings for the asyncio engine async_app.py reads with.
+    asyncpg takes its connect and statement timeouts as arguments of its own.
+    """
+    options = engine_options(config)
+    if 'connect_args' in options:
+        connect_args = {'timeout': config['DB_CONNECT_TIMEOUT']}
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['server_settings'] = {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT_MS'])}
+        options['connect_args'] = connect_args
+    return options
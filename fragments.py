@@ -0,0 +1,90 @@
+import os
+from functools import lru_cache
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from markupsafe import Markup
+
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+class FragmentCache:
+    """
+    A cache of rendered rows for the list pages, like one user's row in the user list.
+    Each row is a macro in templates/fragments.html that takes exactly the values it shows,
+    and the cache is keyed on the macro and those values, so a changed row simply misses and never needs invalidating;
+    the stale entry ages out of the LRU.
+    The macros are rendered by a plain Jinja environment of their own, so the sync and async apps can share them.
+    """
+
+    def __init__(self, max_size=10000):
+        self.env = Environment(loader=FileSystemLoader(TEMPLATE_FOLDER), autoescape=True, auto_reload=False)
+        self.configure(max_size)
+
+    def configure(self, max_size, bytecode_cache=None):
+        """Change the size limit and the bytecode cache the fragments template is loaded through. Clears the cache."""
+        self.max_size = max_size
+        self.env.bytecode_cache = bytecode_cache
+        self.env.cache.clear()
+        # functools' LRU is implemented in C and thread-safe, which keeps a hit down to about the cost of a dict lookup
+        self.render = lru_cache(maxsize=max_size)(self.render_uncached)
+
+    def render_uncached(self, macro, *values):
+        """Call the macro in fragments.html with the values."""
+        return getattr(self.env.get_template('fragments.html').module, macro)(*values)
+
+    def clear(self):
+        """Drop every fragment."""
+        self.render.cache_clear()
+
+    def stats(self):
+        """Return the cache's counters and current size as a dict."""
+        info = self.render.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}
+
+fragment_cache = FragmentCache()
+
+# The list templates call these once per list, so a page is built by joining cached rows in Python
+# rather than running a Jinja loop body per row
+
+def user_rows(users):
+    """The rows of the user list."""
+    render = fragment_cache.render
+    return Markup('\n'.join([render('user_row', user.id, user.first_name, user.last_name, user.post_count) for user in users]))
+
+def tag_rows(tags):
+    """The rows of the tag list."""
+    render = fragment_cache.render
+    return Markup('\n'.join([render('tag_row', tag.id, tag.name, tag.post_count) for tag in tags]))
+
+def post_links(posts):
+    """Links to the posts with their excerpts, for the lists on the user and tag pages."""
+    render = fragment_cache.render
+    return Markup('\n'.join([render('post_link', post.id, post.title, post.excerpt) for post in posts]))
+
+def feed_rows(posts):
+    """The rows of the recent posts feed, with each post's author and date."""
+    render = fragment_cache.render
+    return Markup('\n'.join([render('feed_row', post.id, post.title, post.excerpt, post.user_id, post.user.first_name, post.user.last_name,
+                                     post.created_at.strftime('%b %d %Y')) for post in posts]))
+
+def bytecode_cache(directory, kind):
+    """A bytecode cache in the directory (or the system temp directory if None), with cache files named for the kind of environment."""
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return FileSystemBytecodeCache(directory, pattern=f'__blogly_{kind}_%s.cache')
+
+def init_app(app):
+    """
+    Load templates through a bytecode cache in TEMPLATE_CACHE_DIR (the system temp directory by default),
+    so a new worker process doesn't re-parse them, and compile them all now rather than on each one's first request.
+    Make the fragment functions available to the templates.
+    Works for the Quart app too.
+    """
+    # Jinja compiles templates differently for async environments, but doesn't key its cache files on that
+    kind = 'async' if app.jinja_env.is_async else 'sync'
+    app.jinja_env.bytecode_cache = bytecode_cache(app.config.get('TEMPLATE_CACHE_DIR'), kind)
+    app.jinja_env.globals.update(user_rows=user_rows, tag_rows=tag_rows, post_links=post_links, feed_rows=feed_rows)
+    fragment_cache.configure(max_size=app.config.get('FRAGMENT_CACHE_SIZE', 10000),
+                             bytecode_cache=bytecode_cache(app.config.get('TEMPLATE_CACHE_DIR'), 'fragments'))
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    fragment_cache.env.get_template('fragments.html').module
@@ -0,0 +1,42 @@
+"""
+gunicorn settings, read from the same environment as config.py:
+
+    gunicorn 'app:create_app()'
+
+WEB_CONCURRENCY sets the number of worker processes. Each worker builds its own app, engine and connection pool,
+so with DB_MAX_CONNECTIONS set the pools are sized to share that budget between the workers.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# config.py reads WEB_CONCURRENCY in each worker to size its pool, so make sure it's set to what we're running
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# Connections must not be shared across a fork, so the app (and its engine) is only ever built in the workers
+preload_app = False
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+def on_starting(server):
+    """Start the shared metrics (see instrumentation.py) from zero, rather than adding to the last run's workers."""
+    if os.environ.get('METRICS_DIR'):
+        from instrumentation import clear_snapshots
+        os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+        clear_snapshots(os.environ['METRICS_DIR'])
+
+def child_exit(server, worker):
+    """Keep the counters of a worker that's gone, but stop adding its page cache stats to the live workers' (see instrumentation.py)."""
+    if os.environ.get('METRICS_DIR'):
+        from instrumentation import mark_process_dead
+        mark_process_dead(os.environ['METRICS_DIR'], worker.pid)
+
+def worker_exit(server, worker):
+    """
+    Commit the writes a worker still has queued in write-behind mode (see writebehind.py) before it goes,
+    and save its last metrics for the others to keep serving.
+    """
+    from writebehind import write_queue
+    from instrumentation import write_snapshot
+    write_queue.stop()
+    write_snapshot()
@@ -0,0 +1,349 @@
+"""
+Request, SQL and template timings, served in the Prometheus text format at /metrics.
+
+The numbers are kept in each process's memory. Under gunicorn every worker has its own, and a scrape reaches
+whichever worker accepts it, so on its own /metrics shows one worker's counts, and they jump about between scrapes.
+Set METRICS_DIR to a directory the workers share (and nothing else writes to) to count them all, the way
+prometheus_client's multiprocess mode does:
+- each worker writes a snapshot of its metrics to a file of its own there every METRICS_WRITE_SECONDS seconds, and when it exits,
+  named after its pid and start time, so a new worker that gets an old one's pid doesn't overwrite its counts
+- when a worker exits, gunicorn's child_exit hook calls mark_process_dead, which folds its counters into EXITED_FILE
+  and drops its page cache stats, which were only true of a process that's gone
+- /metrics adds up every file, so the counters only ever go up, even as workers are replaced,
+  while the page cache gauges are the sum of the live workers'
+- gunicorn.conf.py empties the directory when the server starts, so the counts start again from zero with each deploy
+A scrape can be up to METRICS_WRITE_SECONDS behind for the workers other than the one serving it.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from flask import Response, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from cache import page_cache
+
+logger = logging.getLogger('blogly.sql')
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+class Metrics:
+    """
+    A small thread-safe registry of counters and histograms, labelled like Prometheus metrics,
+    that can render itself in the Prometheus text exposition format.
+    Labels are passed as a tuple of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        """Set the HELP text for a metric."""
+        self._help[name] = text
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter."""
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=(), buckets=SECONDS_BUCKETS):
+        """Record a value in a histogram."""
+        with self._lock:
+            series = self._histograms.setdefault(name, (buckets, {}))[1]
+            counts, total, count = series.get(labels) or ([0] * len(buckets), 0, 0)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[labels] = (counts, total + value, count + 1)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Everything recorded so far, as JSON-friendly lists, for merge() in another process."""
+        with self._lock:
+            return {
+                'counters': {
+                    name: [[labels, value] for labels, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                'histograms': {
+                    name: [buckets, [[labels, counts, total, count] for labels, (counts, total, count) in series.items()]]
+                    for name, (buckets, series) in self._histograms.items()
+                }
+            }
+
+    def merge(self, snapshot):
+        """Add a snapshot() to what's been recorded, series by series."""
+        with self._lock:
+            for name, series in snapshot['counters'].items():
+                ours = self._counters.setdefault(name, {})
+                for labels, value in series:
+                    labels = tuple(tuple(pair) for pair in labels)
+                    ours[labels] = ours.get(labels, 0) + value
+
+            for name, (buckets, series) in snapshot['histograms'].items():
+                ours = self._histograms.setdefault(name, (tuple(buckets), {}))[1]
+                for labels, counts, total, count in series:
+                    labels = tuple(tuple(pair) for pair in labels)
+                    old_counts, old_total, old_count = ours.get(labels) or ([0] * len(buckets), 0, 0)
+                    ours[labels] = ([old + new for old, new in zip(old_counts, counts)], old_total + total, old_count + count)
+
+    def render(self, gauges=()):
+        """Render every metric, plus (name, help, value) gauges read at scrape time, in Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += self._header(name, 'counter')
+                lines += [f'{name}{format_labels(labels)} {value}' for labels, value in sorted(series.items())]
+
+            for name, (buckets, series) in sorted(self._histograms.items()):
+                lines += self._header(name, 'histogram')
+                for labels, (counts, total, count) in sorted(series.items()):
+                    for bound, in_bucket in zip(buckets, counts):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", format_number(bound)),))} {in_bucket}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {format_number(total)}')
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        for name, text, value in gauges:
+            lines += [f'# HELP {name} {text}', f'# TYPE {name} gauge', f'{name} {format_number(value)}']
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, kind):
+        header = [f'# TYPE {name} {kind}']
+        if name in self._help:
+            header.insert(0, f'# HELP {name} {self._help[name]}')
+        return header
+
+def format_labels(labels):
+    """Format label pairs as {key="value",...}, escaping the values the way Prometheus expects."""
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = Metrics()
+metrics.describe('blogly_requests_total', 'Requests handled, by endpoint, method and status.')
+metrics.describe('blogly_request_duration_seconds', 'Time to handle a request, by endpoint.')
+metrics.describe('blogly_request_db_seconds', 'Time a request spent waiting on SQL statements, by endpoint.')
+metrics.describe('blogly_request_render_seconds', 'Time a request spent rendering templates, by endpoint.')
+metrics.describe('blogly_request_sql_statements', 'SQL statements run per request, by endpoint.')
+metrics.describe('blogly_sql_statement_seconds', 'Time taken by each SQL statement.')
+metrics.describe('blogly_slow_queries_total', 'SQL statements slower than SLOW_QUERY_MS, by endpoint.')
+
+# The threshold for logging slow queries, set from the app's config by init_app
+slow_query_seconds = 0.1
+
+# Where the worker processes share their metrics, from the METRICS_DIR config value; None to serve this process's alone
+metrics_dir = None
+METRICS_WRITE_SECONDS = 5
+PAGE_CACHE_STATS = ('hits', 'misses', 'evictions', 'invalidations', 'size')
+# The process the snapshot writer thread is running in
+writer_pid = None
+# This process's (pid, start time), which name its snapshot file
+process_key = None
+# The counters of the workers that have exited, kept in metrics_dir alongside the live workers' snapshots
+EXITED_FILE = 'metrics-exited.json'
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Time the statement, add it to the current request's totals, and log it if it was slow."""
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    metrics.observe('blogly_sql_statement_seconds', elapsed)
+
+    endpoint = None
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.db_seconds += elapsed
+        endpoint = request.endpoint
+
+    if elapsed >= slow_query_seconds:
+        metrics.inc('blogly_slow_queries_total', (('endpoint', endpoint or ''),))
+        logger.warning('Slow query (%.1fms) in %s: %s', elapsed * 1000, endpoint or 'no request', ' '.join(statement.split())[:1000])
+
+def discard_failed_execute(context):
+    """A statement that raised never reaches after_cursor_execute, so drop its start time here."""
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+def start_render(sender, template, context, **extra):
+    if 'sql_statements' in g:
+        g.render_started.append(time.perf_counter())
+
+def finish_render(sender, template, context, **extra):
+    if 'sql_statements' in g and g.render_started:
+        g.render_seconds += time.perf_counter() - g.render_started.pop()
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.sql_statements = 0
+    g.db_seconds = 0.0
+    g.render_seconds = 0.0
+    g.render_started = []
+
+def finish_request(response):
+    """Record the request's totals, and send them back in a Server-Timing header too."""
+    if 'sql_statements' not in g:
+        return response
+
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = (('endpoint', request.endpoint or 'none'),)
+
+    metrics.inc('blogly_requests_total', endpoint + (('method', request.method), ('status', response.status_code)))
+    metrics.observe('blogly_request_duration_seconds', elapsed, endpoint)
+    metrics.observe('blogly_request_db_seconds', g.db_seconds, endpoint)
+    metrics.observe('blogly_request_render_seconds', g.render_seconds, endpoint)
+    metrics.observe('blogly_request_sql_statements', g.sql_statements, endpoint, buckets=STATEMENT_BUCKETS)
+
+    response.headers['Server-Timing'] = (
+        f'db;dur={g.db_seconds * 1000:.1f};desc="{g.sql_statements} statements", '
+        f'render;dur={g.render_seconds * 1000:.1f}, total;dur={elapsed * 1000:.1f}'
+    )
+    return response
+
+def snapshot_path():
+    """This process's snapshot file in metrics_dir."""
+    global process_key
+    if process_key is None or process_key[0] != os.getpid():
+        process_key = (os.getpid(), time.time_ns())
+    return os.path.join(metrics_dir, f'metrics-{process_key[0]}-{process_key[1]}.json')
+
+def save_snapshot(snapshot, path):
+    """Write a snapshot to the path, replacing the file in one step, so it's never read half written."""
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(path + '.tmp', path)
+
+def write_snapshot():
+    """Write this process's metrics and page cache stats to its file in metrics_dir."""
+    if metrics_dir is None:
+        return
+    snapshot = metrics.snapshot()
+    snapshot['page_cache'] = {key: page_cache.stats()[key] for key in PAGE_CACHE_STATS}
+    save_snapshot(snapshot, snapshot_path())
+
+def read_snapshot(path):
+    """The snapshot in the file, or None if it's gone or isn't one of ours."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def mark_process_dead(directory, pid):
+    """
+    Fold the counters of the exited worker with the pid into the directory's EXITED_FILE, and delete its snapshot,
+    so they're still counted but its page cache stats aren't. For gunicorn's child_exit hook, which runs in the master.
+    """
+    for path in glob.glob(os.path.join(directory, f'metrics-{pid}-*.json')):
+        snapshot = read_snapshot(path)
+        if snapshot is not None:
+            exited = Metrics()
+            exited_path = os.path.join(directory, EXITED_FILE)
+            for previous in (read_snapshot(exited_path), snapshot):
+                if previous is not None:
+                    exited.merge(previous)
+            save_snapshot(exited.snapshot(), exited_path)
+        os.remove(path)
+
+def write_snapshots():
+    while True:
+        time.sleep(METRICS_WRITE_SECONDS)
+        try:
+            write_snapshot()
+        except OSError:
+            logger.exception('Writing the metrics snapshot failed')
+
+def start_snapshot_writer():
+    """Start writing this process's snapshots in the background, once per process."""
+    global writer_pid
+    if writer_pid == os.getpid():
+        return
+    writer_pid = os.getpid()
+    threading.Thread(target=write_snapshots, name='blogly-metrics', daemon=True).start()
+
+def clear_snapshots(directory):
+    """Delete the snapshots in the directory, for a fresh start."""
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        os.remove(path)
+
+def collect():
+    """
+    The metrics and page cache stats to serve: this process's own, or with metrics_dir set, the sum of every process's snapshot.
+    This process's snapshot is written first, so it's never behind.
+    Only the live workers' snapshots have page cache stats, since mark_process_dead drops an exited worker's.
+    """
+    if metrics_dir is None:
+        stats = page_cache.stats()
+        return metrics, {key: stats[key] for key in PAGE_CACHE_STATS}
+
+    write_snapshot()
+    combined = Metrics()
+    combined._help = metrics._help
+    stats = dict.fromkeys(PAGE_CACHE_STATS, 0)
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics-*.json')):
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            # A worker that exited while being read, or a file that isn't ours
+            continue
+        combined.merge(snapshot)
+        for key in PAGE_CACHE_STATS:
+            stats[key] += snapshot.get('page_cache', {}).get(key, 0)
+    return combined, stats
+
+def show_metrics():
+    """Serve the metrics in the Prometheus text format."""
+    collected, stats = collect()
+    gauges = [
+        (f'blogly_page_cache_{key}', f'Page cache {key.replace("_", " ")}.', stats[key])
+        for key in PAGE_CACHE_STATS
+    ]
+    return Response(collected.render(gauges), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    """
+    Instrument an app: time every SQL statement and template render, record per-request totals,
+    log statements slower than the SLOW_QUERY_MS config value, and serve everything at /metrics.
+    With the METRICS_DIR config value set, share them with the app's other worker processes there.
+    """
+    global slow_query_seconds, metrics_dir
+    slow_query_seconds = app.config.get('SLOW_QUERY_MS', 100) / 1000
+    metrics_dir = app.config.get('METRICS_DIR')
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+        start_snapshot_writer()
+
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', discard_failed_execute)
+
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
+
+# So a worker's last counts aren't lost when it exits between snapshots
+atexit.register(write_snapshot)
@@ -1,13 +1,159 @@
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-
-db = SQLAlchemy()
+from routing import RoutingSQLAlchemy
+from sqlalchemy import event, DDL, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import FunctionElement
+from collections import Counter
+from cache import page_cache
+from registry import TagRegistry
+from related import RelatedIndex
+import sqlite3
+
+# Reads in GET requests can go to a replica, see routing.py
+db = RoutingSQLAlchemy()
 
 def connect_db(app):
     """Connect to database."""
     db.app = app
     db.init_app(app)
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite leaves FK constraints (and so ON DELETE CASCADE) off unless each connection turns them on."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+def invalidate_on_commit(*deps):
+    """
+    Queue page cache dependency keys to be invalidated once the current transaction commits.
+    If the transaction rolls back instead, nothing changed and the keys are dropped.
+    """
+    db.session.info.setdefault('invalidate', set()).update(deps)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    """Invalidate the cached pages that depended on anything this transaction changed."""
+    deps = session.info.pop('invalidate', None)
+    if deps:
+        page_cache.invalidate(*deps)
+        if 'tags' in deps:
+            tag_registry.clear()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_invalidations(session):
+    """Forget the invalidations queued by a transaction that was rolled back."""
+    session.info.pop('invalidate', None)
+
+def tag_links_on_commit(post_id, tag_ids):
+    """
+    Queue a change to a post's tags, to the set of tag ids passed, for the related posts index
+    once the current transaction commits. Pass a post_id of None when too much changed to list, to reload the index instead.
+    """
+    db.session.info.setdefault('tag_links', []).append((post_id, tag_ids))
+
+@event.listens_for(Session, 'after_commit')
+def apply_tag_links(session):
+    """Bring the related posts index up to date with the tag links this transaction changed."""
+    for post_id, tag_ids in session.info.pop('tag_links', ()):
+        if post_id is None:
+            related_index.clear()
+        else:
+            related_index.change(post_id, tag_ids)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_tag_links(session):
+    session.info.pop('tag_links', None)
+
+class utcnow(FunctionElement):
+    """The current UTC time when the statement runs, worked out by the database, for server-side column defaults."""
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow, 'postgresql')
+def pg_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', STATEMENT_TIMESTAMP())"
+
+@compiles(utcnow, 'sqlite')
+def sqlite_utcnow(element, compiler, **kw):
+    # Microseconds padded out to the format SQLA stores datetimes in on SQLite, so they sort and compare as the same strings
+    return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'now')"
+
+# The most characters of a post's content the list pages show
+EXCERPT_LENGTH = 200
+
+def make_excerpt(content):
+    """The start of the content, with its whitespace collapsed, cut at a word break with an ellipsis if it's too long."""
+    text = ' '.join(content.split())
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = text.rfind(' ', 0, EXCERPT_LENGTH)
+    return text[:cut if cut > 0 else EXCERPT_LENGTH] + '…'
+
+# How many rows to adjust in each UPDATE when changing post counts
+COUNT_BATCH_SIZE = 1000
+
+def adjust_post_counts(model, deltas):
+    """
+    Add the deltas (a mapping of id -> change) to the post_count column of User or Tag rows, without committing.
+    Every row is changed by one UPDATE using a CASE on the id, so a batch of posts costs one statement per table.
+    Their updated_at is set too, since their details pages list their posts (see version()).
+    """
+    deltas = {row_id: delta for row_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    # Update in id order so concurrent transactions take the row locks in the same order
+    ids = sorted(deltas)
+    for start in range(0, len(ids), COUNT_BATCH_SIZE):
+        batch = ids[start:start + COUNT_BATCH_SIZE]
+        model.query.filter(model.id.in_(batch)).update(
+            {model.post_count: model.post_count + db.case({row_id: deltas[row_id] for row_id in batch}, value = model.id),
+             model.updated_at: utcnow()},
+            synchronize_session = False
+        )
+
+    kind = 'user' if model is User else 'tag'
+    invalidate_on_commit(f'{kind}_counts', *((f'{kind}_posts', row_id) for row_id in ids))
+
+def touch(model, ids):
+    """
+    Set updated_at to now on the rows of the model with the ids, which may be a subquery, without committing.
+    For the users and tags whose details pages list a post that changed.
+    """
+    model.query.filter(model.id.in_(ids)).update({model.updated_at: utcnow()}, synchronize_session = False)
+
+def repair_post_counts():
+    """
+    Recompute every user's and tag's post_count from the posts and posts_tags tables, and commit.
+    Returns how many users and tags had the wrong count.
+    """
+    user_count = db.select(db.func.count(Post.id)).where(Post.user_id == User.id).scalar_subquery()
+    users_fixed = User.query.filter(User.post_count != user_count).update(
+        {User.post_count: user_count, User.updated_at: utcnow()}, synchronize_session = False)
+
+    tag_count = db.select(db.func.count(PostTag.post_id)).where(PostTag.tag_id == Tag.id).scalar_subquery()
+    tags_fixed = Tag.query.filter(Tag.post_count != tag_count).update(
+        {Tag.post_count: tag_count, Tag.updated_at: utcnow()}, synchronize_session = False)
+
+    db.session.commit()
+    page_cache.clear()
+    return users_fixed, tags_fixed
+
+def reset_sequences(*tables):
+    """
+    Postgres sequences don't move when we insert explicit ids, so point the tables' id sequences past the rows they have.
+    Without committing.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+        ))
+
 class User(db.Model):
     """
     The class we'll use to model our user data.
@@ -30,6 +176,18 @@ class User(db.Model):
     image = db.Column(db.Text,
                         default= 'https://images.unsplash.com/photo-1601027847350-0285867c31f7?ixid=MXwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHw%3D&ixlib=rb-1.2.1&auto=format&fit=crop&w=668&q=80')
 
+    updated_at = db.Column(db.DateTime,
+                            nullable = False,
+                            server_default = utcnow())
+
+    post_count = db.Column(db.Integer,
+                            nullable = False,
+                            default = 0,
+                            server_default = '0')
+
+    # Backs the keyset pagination of the user list sorted by popularity
+    __table_args__ = (db.Index('ix_users_post_count', 'post_count', 'id'),)
+
     def edit(self, first, last, image):
         """
         Update the user's information in the database.
@@ -41,23 +199,62 @@ class User(db.Model):
             self.last_name = last
         if image:
             self.image = image
+        self.updated_at = utcnow()
         
+        invalidate_on_commit('users', ('user', self.id))
         db.session.commit()
 
 
     @classmethod
-    def commit_new_user(cls, first, last, image):
-        """Creates a new User instance and commits it to the database"""
+    def version(cls, user_id):
+        """
+        Get what the user's details page was built from, for conditional requests, by primary key without loading the user:
+        (when the user or any of their posts last changed, how many posts they have).
+        None if the user doesn't exist.
+        """
+        return db.session.execute(cls.version_select(user_id)).first()
+
+    @classmethod
+    def version_select(cls, user_id):
+        """The query behind version(), as a select() the async pages can run too."""
+        return db.select(cls.updated_at, cls.post_count).where(cls.id == user_id)
+
+    @classmethod
+    def commit_new_user(cls, first, last, image, commit=True):
+        """
+        Creates a new User instance and commits it to the database.
+        Pass commit=False to leave it in the open transaction, for the write-behind queue to commit with others.
+        """
         new_user = cls(first_name=first, last_name=last, image=image)
         db.session.add(new_user)
+        invalidate_on_commit('users')
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def delete_user(cls, user_id):
+        """
+        Delete the user with the ID passed, and commit.
+        The DB cascades the delete to their posts and those posts' tag relationships,
+        so first we take those posts off the post counts of their tags.
+        """
+        tag_counts = db.session.query(PostTag.tag_id, db.func.count()).join(Post).filter(
+            Post.user_id == user_id
+        ).group_by(PostTag.tag_id)
+        adjust_post_counts(Tag, {tag_id: -count for tag_id, count in tag_counts})
+
+        invalidate_on_commit('users', ('user', user_id))
+        tag_links_on_commit(None, None)
+        cls.query.filter_by(id=user_id).delete()
         db.session.commit()
 
 class Post(db.Model):
     """
     Class used to model a post.
     Must have a title and content.
-    created_at will default to the time the record is created.
-    user_id is a FK linking to the User model.
+    The content is only loaded when it's read; excerpt holds the start of it for the list pages, and is kept up to date whenever it's set.
+    created_at and updated_at are set by the database, from its own clock, to the time each row is inserted or edited.
+    user_id is a FK linking to the User model. Deleting a user deletes their posts in the DB.
     """
 
     __tablename__ = 'posts'
@@ -73,63 +270,272 @@ class Post(db.Model):
         nullable = False
     )
 
-    content = db.Column(
+    content = db.deferred(db.Column(
         db.Text,
         nullable = False
+    ))
+
+    excerpt = db.Column(
+        db.Text,
+        nullable = False,
+        default = '',
+        server_default = ''
     )
 
     created_at = db.Column(
         db.DateTime,
         nullable = False,
-        default = datetime.today()
+        server_default = utcnow()
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        server_default = utcnow()
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id'),
+        db.ForeignKey('users.id', ondelete = 'CASCADE'),
         nullable = False
     )
 
-    user = db.relationship('User', backref='posts')
+    user = db.relationship('User', backref=db.backref('posts', passive_deletes=True))
+
+    # Back the keyset pagination of the recent posts feed, and of each user's posts newest first
+    __table_args__ = (
+        db.Index('ix_posts_created_at', 'created_at', 'id'),
+        db.Index('ix_posts_user_id_created_at', 'user_id', 'created_at', 'id')
+    )
+
+    @db.validates('content')
+    def set_excerpt(self, key, content):
+        self.excerpt = make_excerpt(content)
+        return content
+
+    @classmethod
+    def version(cls, post_id):
+        """
+        Get what the post's page was built from, for conditional requests, without loading the post:
+        (when the post was updated, when its author was updated, when any of its tags was last updated, how many tags it has).
+        None if the post doesn't exist.
+        """
+        return db.session.execute(cls.version_select(post_id)).first()
+
+    @classmethod
+    def version_select(cls, post_id):
+        """The query behind version(), as a select() the async pages can run too."""
+        return db.select(
+            cls.updated_at,
+            User.updated_at,
+            db.func.max(Tag.updated_at),
+            db.func.count(Tag.id)
+        ).select_from(cls).join(User).outerjoin(PostTag).outerjoin(Tag).where(
+            cls.id == post_id
+        ).group_by(cls.id, cls.updated_at, User.updated_at)
+
+    @classmethod
+    def search(cls, terms, page=1, per_page=20):
+        """
+        Full-text search over post titles and content, best matches first, with title matches ranked above content matches.
+        Uses the GIN-indexed search_vector column on Postgres, and the posts_fts FTS5 table on SQLite.
+        Returns a list of up to per_page posts for the 1-based page asked for, and whether there's another page.
+        """
+        offset = (page - 1) * per_page
+
+        if db.engine.dialect.name == 'postgresql':
+            vector = db.literal_column('posts.search_vector')
+            query = db.func.websearch_to_tsquery('english', terms)
+            posts = cls.query.options(db.load_only(*POST_LIST_COLUMNS)).filter(
+                vector.op('@@')(query)
+            ).order_by(
+                db.func.ts_rank_cd(vector, query).desc(),
+                cls.id.desc()
+            ).offset(offset).limit(per_page + 1).all()
+        else:
+            # Quote every word so FTS5 treats the user's input as plain terms rather than query syntax
+            match = ' '.join('"{}"'.format(word.replace('"', '""')) for word in terms.split())
+            if not match:
+                return [], False
+            ids = [post_id for (post_id,) in db.session.execute(
+                text("""SELECT rowid FROM posts_fts WHERE posts_fts MATCH :match
+                        ORDER BY bm25(posts_fts, 10.0, 1.0), rowid DESC LIMIT :limit OFFSET :offset"""),
+                {'match': match, 'limit': per_page + 1, 'offset': offset}
+            )]
+            by_id = {post.id: post for post in cls.query.options(db.load_only(*POST_LIST_COLUMNS)).filter(cls.id.in_(ids))}
+            posts = [by_id[post_id] for post_id in ids if post_id in by_id]
+
+        return posts[:per_page], len(posts) > per_page
+
+    @classmethod
+    def tag_filter(cls, tags, match_all=True):
+        """
+        WHERE clauses for the posts with all (or any) of the tags, which need an id and a post_count, like Tag rows.
+        For all, the posts come from the tag with the fewest, read in post id order from the (tag_id, post_id) index on posts_tags,
+        and are checked against the other tags from the smallest up, so most are ruled out by the first check.
+        Works on a Query or a select().
+        """
+        if not tags:
+            return [db.false()]
+        if not match_all:
+            return [cls.id.in_(db.select(PostTag.post_id).where(PostTag.tag_id.in_([tag.id for tag in tags])))]
+
+        smallest, *rest = sorted(tags, key=lambda tag: (tag.post_count, tag.id))
+        return [
+            cls.id.in_(db.select(PostTag.post_id).where(PostTag.tag_id == smallest.id)),
+            *(db.exists().where(PostTag.post_id == cls.id, PostTag.tag_id == tag.id) for tag in rest)
+        ]
+
+    @classmethod
+    def get_details_or_404(cls, post_id):
+        """
+        Get a post for the details and edit pages. 404 if not found.
+        The content and author are loaded in the same query, and the tags come in one extra query.
+        """
+        return cls.query.options(
+            db.undefer(cls.content),
+            db.joinedload(cls.user),
+            db.selectinload(cls.tags)
+        ).get_or_404(post_id)
 
     @classmethod
-    def commit_new_post(cls, user_id, title, content, tags):
+    def commit_new_post(cls, user_id, title, content, tags, commit=True):
         """
         Create a new Post from the data passed and commit it to the DB.
-        If any tags were passed, create a relationship between the new post and each tag.
+        If any tags were passed, create a relationship between the new post and each tag in the same transaction.
+        Pass commit=False to leave the transaction open instead.
+        Returns the new post.
         """
-        new_post = Post(user_id=user_id, title=title, content=content)
-        db.session.add(new_post)
-        db.session.commit()
+        [new_post] = cls.commit_new_posts([{
+            'user_id': user_id,
+            'title': title,
+            'content': content,
+            'tags': tags
+        }], commit=commit)
+        return new_post
 
-        #Add tags afterwards so that we can use the id returned from SQLA
-        if tags:
-            for tag in tags:
-                tag_int = int(tag)
-                post_tag = PostTag(post_id = new_post.id, tag_id = tag_int)
-                db.session.add(post_tag)
+    @classmethod
+    def commit_new_posts(cls, posts, commit=True):
+        """
+        Create many posts and their tag relationships in a single transaction.
+        Each item is a dict with user_id, title, content and an optional list of tag ids, the same as commit_new_post takes.
+        Ids that aren't numbers or don't belong to a tag are ignored, the same as edit does.
+        Pass commit=False to flush the posts but leave the transaction open.
+        Returns the new posts in the order they were passed.
+        """
+        new_posts = [cls(user_id=post['user_id'], title=post['title'], content=post['content']) for post in posts]
+        db.session.add_all(new_posts)
+
+        # Flush rather than commit, so SQLA gives us the new ids while the transaction is still open
+        db.session.flush()
+
+        wanted = [{int(tag) for tag in post.get('tags') or [] if str(tag).isdecimal()} for post in posts]
+        existing = Tag.existing_ids(set().union(*wanted))
+        post_tags = [
+            {'post_id': new_post.id, 'tag_id': tag_id}
+            for new_post, tag_ids in zip(new_posts, wanted)
+            for tag_id in tag_ids & existing
+        ]
+        if post_tags:
+            db.session.execute(PostTag.__table__.insert(), post_tags)
+            tagged = {}
+            for post_tag in post_tags:
+                tagged.setdefault(post_tag['post_id'], set()).add(post_tag['tag_id'])
+            for post_id, tag_ids in tagged.items():
+                tag_links_on_commit(post_id, tag_ids)
+
+        adjust_post_counts(User, Counter(new_post.user_id for new_post in new_posts))
+        adjust_post_counts(Tag, Counter(post_tag['tag_id'] for post_tag in post_tags))
+
+        invalidate_on_commit('posts')
+        if commit:
             db.session.commit()
+        return new_posts
+
+    @classmethod
+    def delete_post(cls, post_id):
+        """
+        Delete the post with the ID passed, and commit.
+        The DB cascades the delete to its tag relationships, so first we take it off its user's and tags' post counts.
+        Returns the ID of the user who wrote it, or None if there was no such post.
+        """
+        user_id = db.session.query(cls.user_id).filter_by(id=post_id).scalar()
+        if user_id is None:
+            return None
+
+        tag_ids = {tag_id for (tag_id,) in db.session.query(PostTag.tag_id).filter_by(post_id=post_id)}
+        adjust_post_counts(User, {user_id: -1})
+        adjust_post_counts(Tag, {tag_id: -1 for tag_id in tag_ids})
+
+        invalidate_on_commit(('post', post_id))
+        tag_links_on_commit(post_id, set())
+        cls.query.filter_by(id=post_id).delete()
+        db.session.commit()
+        return user_id
+
+    @classmethod
+    def edit_post(cls, post_id, title, content, tags, commit=True):
+        """
+        Edit the post with the ID passed, like edit, for callers that only have the ID, like the write-behind queue.
+        Returns False if there was no such post.
+        """
+        post = cls.query.get(post_id)
+        if post is None:
+            return False
+        post.edit(title=title, content=content, tags=tags, commit=commit)
+        return True
 
-    def edit(self, title, content, tags):
+    def edit(self, title, content, tags, commit=True):
         """
         Edit the records for a post with the data passed to this method.
-        We'll need to create or remove relationships for all of the tags that were checked or not checked, also.
+        Tag relationships are synced by comparing the checked tag ids against the post's current posts_tags rows,
+        so we only insert the ones that were added and delete the ones that were removed, in one statement each.
+        Pass commit=False to leave the transaction open.
         """
         self.title = title
         self.content = content
+        self.updated_at = utcnow()
+
+        self.sync_tags(tags)
+        # The user's and tags' pages list the post's title
+        touch(User, [self.user_id])
+        touch(Tag, db.select(PostTag.tag_id).where(PostTag.post_id == self.id))
+        invalidate_on_commit(('post', self.id))
+        if commit:
+            db.session.commit()
 
-        # loop through all tags to see if we need to add or remove relationships
-        all_tags = Tag.query.all()
-        for tag in all_tags:
-            #Check if a tag was checked in the form that was sent, and if it isn't already in this posts tag add it
-            if str(tag.id) in tags:
-                if tag not in self.tags:
-                    self.tags.append(tag)
-            #If the tag is not checked, delete any relationships between the tag and the post
-            else:
-                PostTag.query.filter_by(post_id = self.id, tag_id = tag.id).delete()
-
-        db.session.commit()
+    def sync_tags(self, tags):
+        """
+        Make the post's posts_tags rows match the tag ids passed, without committing.
+        Returns the sets of tag ids that were added and removed.
+        """
+        wanted = {int(tag) for tag in tags if str(tag).isdecimal()}
+        current = {tag_id for (tag_id,) in db.session.query(PostTag.tag_id).filter_by(post_id = self.id)}
+
+        added = wanted - current
+        removed = current - wanted
+
+        # Ignore any ids that don't belong to a tag, the same as the form would
+        added = Tag.existing_ids(added)
+
+        if added:
+            db.session.execute(
+                PostTag.__table__.insert(),
+                [{'post_id': self.id, 'tag_id': tag_id} for tag_id in added]
+            )
+        if removed:
+            PostTag.query.filter(
+                PostTag.post_id == self.id,
+                PostTag.tag_id.in_(removed)
+            ).delete(synchronize_session = False)
+
+        # The relationship was loaded from rows we just changed behind the ORM's back
+        if added or removed:
+            db.session.expire(self, ['tags'])
+            adjust_post_counts(Tag, {**{tag_id: 1 for tag_id in added}, **{tag_id: -1 for tag_id in removed}})
+            tag_links_on_commit(self.id, (current - removed) | added)
+
+        return added, removed
 
 class Tag(db.Model):
     """
@@ -152,9 +558,26 @@ class Tag(db.Model):
         nullable = False
     )
 
+    updated_at = db.Column(
+        db.DateTime,
+        nullable = False,
+        server_default = utcnow()
+    )
+
+    post_count = db.Column(
+        db.Integer,
+        nullable = False,
+        default = 0,
+        server_default = '0'
+    )
+
+    # Backs the keyset pagination of the tag list sorted by popularity
+    __table_args__ = (db.Index('ix_tags_post_count', 'post_count', 'id'),)
+
     attachments = db.relationship(
         'PostTag',
-        backref = 'tag'
+        backref = 'tag',
+        passive_deletes = True
     )
 
     posts = db.relationship(
@@ -164,14 +587,43 @@ class Tag(db.Model):
     )
 
     @classmethod
-    def commit_new_tag(cls, name):
+    def version(cls, tag_id):
+        """
+        Get what the tag's details page was built from, for conditional requests, by primary key without loading the tag:
+        (when the tag or any of its posts last changed, how many posts it has).
+        None if the tag doesn't exist.
+        """
+        return db.session.execute(cls.version_select(tag_id)).first()
+
+    @classmethod
+    def version_select(cls, tag_id):
+        """The query behind version(), as a select() the async pages can run too."""
+        return db.select(cls.updated_at, cls.post_count).where(cls.id == tag_id)
+
+    @classmethod
+    def existing_ids(cls, tag_ids):
+        """
+        The set of the ids passed that belong to a tag, in one query.
+        Writes check their tag ids with this rather than the tag registry, which may not have another process's new tags
+        or know that one was just deleted; it reads from the primary, since the write routes never use a replica.
+        """
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return tag_ids
+        return {tag_id for (tag_id,) in db.session.query(cls.id).filter(cls.id.in_(tag_ids))}
+
+    @classmethod
+    def commit_new_tag(cls, name, commit=True):
         """
         Commit a new tag to the database from the name passed.
         Name should be stored as all lowercase.
+        Pass commit=False to leave it in the open transaction.
         """
         new_tag = Tag(name=name.lower())
         db.session.add(new_tag)
-        db.session.commit()
+        invalidate_on_commit('tags')
+        if commit:
+            db.session.commit()
 
     def edit(self, name):
         """
@@ -179,26 +631,86 @@ class Tag(db.Model):
         Make sure the new name is saved as lowercase.
         """
         self.name = name.lower()
+        self.updated_at = utcnow()
+        invalidate_on_commit('tags', ('tag', self.id))
         db.session.commit()
 
+    @classmethod
+    def delete_tag(cls, tag_id):
+        """
+        Delete the tag with the ID passed, and commit.
+        The DB cascades the delete to its tag/post relationships. Post counts are only kept for users and tags, so none change,
+        but the tag's posts are marked as updated, since their pages listed it.
+        """
+        Post.query.filter(Post.id.in_(db.select(PostTag.post_id).where(PostTag.tag_id == tag_id))).update(
+            {Post.updated_at: utcnow()}, synchronize_session = False)
+        invalidate_on_commit('tags', ('tag', tag_id))
+        tag_links_on_commit(None, None)
+        cls.query.filter_by(id=tag_id).delete()
+        db.session.commit()
+
+# The columns the list pages show, or page through, for each post
+POST_LIST_COLUMNS = (Post.id, Post.user_id, Post.title, Post.excerpt, Post.created_at)
+
+# Every tag's id and name, kept in memory for the post forms and tag validation.
+# The tag write paths queue the 'tags' invalidation, which clears it when they commit.
+tag_registry = TagRegistry(lambda: db.session.query(Tag.id, Tag.name))
+
+# Every post's tag ids, kept in memory for the related posts on the post page.
+# The write paths queue their changes with tag_links_on_commit, which applies them when they commit.
+related_index = RelatedIndex(lambda: db.session.query(PostTag.post_id, PostTag.tag_id).order_by(PostTag.post_id).yield_per(10000))
+
+# The search index lives outside the ORM, since each database builds it differently.
+# On Postgres it's a generated tsvector column with a GIN index, so it can never drift from the post.
+event.listen(Post.__table__, 'after_create', DDL("""
+    ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(content, '')), 'B')
+    ) STORED
+""").execute_if(dialect='postgresql'))
+event.listen(Post.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)"
+).execute_if(dialect='postgresql'))
+
+# On SQLite (for local testing) it's an external-content FTS5 table kept in sync by triggers
+for statement in [
+    "CREATE VIRTUAL TABLE posts_fts USING fts5(title, content, content='posts', content_rowid='id')",
+    """CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER posts_fts_update AFTER UPDATE OF title, content ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+    END"""
+]:
+    event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect='sqlite'))
+
 
 class PostTag(db.Model):
     """
     Model for a join table between Posts and Tags.
     Uses a composite primary key between the post_id and tag_id.
     Both fields are necessary to create a new instance.
+    Rows are deleted by the DB when either their post or their tag is deleted.
     """
 
     __tablename__ = "posts_tags"
 
+    # The primary key finds a post's tags; this finds a tag's posts in post id order, without visiting the table
+    __table_args__ = (db.Index('ix_posts_tags_tag_id_post_id', 'tag_id', 'post_id'),)
+
     post_id = db.Column(
         db.Integer,
-        db.ForeignKey('posts.id'),
+        db.ForeignKey('posts.id', ondelete = 'CASCADE'),
         primary_key = True
     )
 
     tag_id = db.Column(
         db.Integer,
-        db.ForeignKey('tags.id'),
+        db.ForeignKey('tags.id', ondelete = 'CASCADE'),
         primary_key = True
     )
\ No newline at end of file
@@ -0,0 +1,112 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import DateTime, literal, tuple_
+
+Page = namedtuple('Page', ['items', 'prev_cursor', 'next_cursor'])
+
+def encode_cursor(values):
+    """Pack the sort key of a row into an opaque, URL-safe cursor string. Datetimes are packed in ISO format."""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor, columns):
+    """
+    Unpack a cursor made by encode_cursor.
+    Raises ValueError if the cursor is malformed or doesn't match the columns we sort on.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from exc
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+
+    try:
+        return [cursor_value(value, column) for value, column in zip(values, columns)]
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from exc
+
+# The range of a Postgres bigint, so an out of range id is a bad cursor rather than a database error
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+
+def cursor_value(value, column):
+    """
+    Check a value from a cursor against the type of the column it's compared to, parsing datetimes from ISO format.
+    Raises ValueError if it's the wrong type.
+    """
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError(f'Expected a datetime for {column.key}, not {value!r}')
+        return datetime.fromisoformat(value)
+
+    expected = column.type.python_type
+    # bool is an int to Python, but not to the database
+    if not isinstance(value, expected) or isinstance(value, bool):
+        raise ValueError(f'Expected {expected.__name__} for {column.key}, not {value!r}')
+    if expected is int and not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise ValueError(f'{column.key} out of range: {value!r}')
+    return value
+
+def keyset_page(query, columns, after=None, before=None, per_page=50, descending=False):
+    """
+    Return one Page of the query, ordered by the given columns, using keyset pagination.
+    The columns together must be unique (end with a primary key or unique column) and should be indexed,
+    so every page is an index range scan no matter how deep into the list we are.
+    Pass the next_cursor of a page as `after` to get the following page, or its prev_cursor as `before` to go back.
+    """
+    rows = keyset_query(query, columns, after, before, per_page, descending).all()
+    return page_from_rows(rows, columns, after, before, per_page)
+
+def keyset_query(query, columns, after=None, before=None, per_page=50, descending=False):
+    """
+    Filter, order and limit the query for the page keyset_page would return, without running it.
+    Works on a Query or a select(), so the async pages can run it on their own session and pass the rows to page_from_rows.
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+
+    # Walking backwards flips the ordering, and page_from_rows reverses the rows again
+    reverse_order = descending != backwards
+
+    if cursor is not None:
+        values = decode_cursor(cursor, columns)
+        bound = [literal(value, column.type) for value, column in zip(values, columns)]
+        if len(columns) == 1:
+            key, bound = columns[0], bound[0]
+        else:
+            key, bound = tuple_(*columns), tuple_(*bound)
+        query = query.filter(key < bound if reverse_order else key > bound)
+
+    ordering = [column.desc() if reverse_order else column.asc() for column in columns]
+
+    # Ask for one extra row so we know whether there's anything past this page
+    return query.order_by(*ordering).limit(per_page + 1)
+
+def page_from_rows(rows, columns, after=None, before=None, per_page=50):
+    """Make the Page from the rows of a keyset_query run with the same arguments."""
+    backwards = before is not None
+    more = len(rows) > per_page
+    rows = list(rows[:per_page])
+
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+
+    if not rows:
+        return Page(rows, None, None)
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, column.key) for column in columns)
+
+    return Page(
+        rows,
+        cursor_for(rows[0]) if has_prev else None,
+        cursor_for(rows[-1]) if has_next else None
+    )
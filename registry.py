@@ -0,0 +1,91 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+TagEntry = namedtuple('TagEntry', ['id', 'name'])
+
+class TagSnapshot:
+    """
+    An immutable copy of every tag's id and name, held as two sorted views searched by bisection:
+    ids in an array with their names alongside, and names with their ids in an array alongside.
+    """
+
+    def __init__(self, rows, expires_at):
+        by_id = sorted(rows)
+        by_name = sorted(rows, key=lambda row: row[1])
+        self.ids = array('q', (tag_id for tag_id, _ in by_id))
+        self.names_by_id = tuple(name for _, name in by_id)
+        self.names = tuple(name for _, name in by_name)
+        self.ids_by_name = array('q', (tag_id for tag_id, _ in by_name))
+        self.expires_at = expires_at
+
+class TagRegistry:
+    """
+    A process-wide copy of the tags table's ids and names, so forms, autocomplete and the post page don't have to query it.
+    It can be a ttl behind other processes, so writes check their tag ids against the database instead (see Tag.existing_ids).
+    Loaded on first use with the load function, which returns (id, name) rows.
+    Dropped by clear() when a tag write commits, and reloaded at least every ttl seconds to pick up other processes' writes.
+    """
+
+    def __init__(self, load, ttl=60):
+        self._load = load
+        self.ttl = ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def configure(self, ttl):
+        """Change the time to live. Clears the registry."""
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        """Forget every tag, so the next lookup reloads them."""
+        with self._lock:
+            self.generation += 1
+            self._snapshot = None
+
+    def snapshot(self):
+        """
+        The current TagSnapshot, loading a new one if there isn't one or it has expired.
+        Like the page cache, a snapshot loaded while a clear() happened is used once but not kept.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.expires_at > time.monotonic():
+            return snapshot
+
+        generation = self.generation
+        snapshot = TagSnapshot([tuple(row) for row in self._load()], time.monotonic() + self.ttl)
+        with self._lock:
+            if generation == self.generation:
+                self._snapshot = snapshot
+        return snapshot
+
+    def all(self):
+        """Every tag as a TagEntry, in name order."""
+        snapshot = self.snapshot()
+        return [TagEntry(tag_id, name) for tag_id, name in zip(snapshot.ids_by_name, snapshot.names)]
+
+    def name(self, tag_id):
+        """The name of the tag with the id, or None if there isn't one."""
+        snapshot = self.snapshot()
+        i = bisect_left(snapshot.ids, tag_id)
+        return snapshot.names_by_id[i] if i < len(snapshot.ids) and snapshot.ids[i] == tag_id else None
+
+    def find(self, name):
+        """The id of the tag with the name, or None if there isn't one."""
+        snapshot = self.snapshot()
+        i = bisect_left(snapshot.names, name)
+        return snapshot.ids_by_name[i] if i < len(snapshot.names) and snapshot.names[i] == name else None
+
+    def complete(self, prefix, limit=10):
+        """Up to limit tags whose names start with the prefix, as TagEntries in name order."""
+        snapshot = self.snapshot()
+        matches = []
+        i = bisect_left(snapshot.names, prefix)
+        while i < len(snapshot.names) and len(matches) < limit and snapshot.names[i].startswith(prefix):
+            matches.append(TagEntry(snapshot.ids_by_name[i], snapshot.names[i]))
+            i += 1
+        return matches
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import groupby
+
+# How many of each tag's newest posts are considered for a post's related posts,
+# so a popular tag costs no more than a rare one
+CANDIDATES_PER_TAG = 500
+
+class TagLinks:
+    """
+    An in-memory copy of the posts_tags table, built from (post_id, tag_id) rows in post id order:
+    - posts_by_tag maps each tag id to an array of its post ids, in ascending order
+    - cooccurrence is a sparse tag x tag matrix of how many posts have both tags, stored as one row per tag:
+      an array of the other tag ids in ascending order, and an array of the counts alongside
+    - tags_by_post maps each tagged post's id to its tag ids, so change() knows what the links already say about a post
+    All three are changed in place by change() as links are added and removed, under the lock passed in.
+    """
+
+    def __init__(self, rows, expires_at, lock):
+        self.lock = lock
+        self.expires_at = expires_at
+        self.posts_by_tag = defaultdict(lambda: array('q'))
+        self.tags_by_post = {}
+        pairs = defaultdict(Counter)
+
+        for post_id, links in groupby(rows, key=lambda row: row[0]):
+            tag_ids = sorted({tag_id for _, tag_id in links})
+            self.tags_by_post[post_id] = tuple(tag_ids)
+            for tag_id in tag_ids:
+                self.posts_by_tag[tag_id].append(post_id)
+                pairs[tag_id].update(other for other in tag_ids if other != tag_id)
+
+        self.cooccurrence = {}
+        for tag_id, counts in pairs.items():
+            others = sorted(counts)
+            self.cooccurrence[tag_id] = (array('q', others), array('q', (counts[other] for other in others)))
+
+    def change(self, post_id, after):
+        """
+        Give the post the tag ids in after, from whatever tags the links have for it now.
+        Setting the tags it already has changes nothing, so a change the links were loaded with isn't counted twice.
+        """
+        with self.lock:
+            before = set(self.tags_by_post.get(post_id, ()))
+            if before == after:
+                return
+            if after:
+                self.tags_by_post[post_id] = tuple(sorted(after))
+            else:
+                self.tags_by_post.pop(post_id, None)
+
+            for tag_id in before - after:
+                posts = self.posts_by_tag[tag_id]
+                i = bisect_left(posts, post_id)
+                if i < len(posts) and posts[i] == post_id:
+                    del posts[i]
+            for tag_id in after - before:
+                posts = self.posts_by_tag[tag_id]
+                i = bisect_left(posts, post_id)
+                if i == len(posts) or posts[i] != post_id:
+                    posts.insert(i, post_id)
+
+            for tags, delta in ((before, -1), (after, 1)):
+                for tag_id in tags:
+                    for other in tags:
+                        if other != tag_id:
+                            self._add_pair(tag_id, other, delta)
+
+    def _add_pair(self, tag_id, other, delta):
+        others, counts = self.cooccurrence.setdefault(tag_id, (array('q'), array('q')))
+        i = bisect_left(others, other)
+        if i < len(others) and others[i] == other:
+            counts[i] += delta
+            if counts[i] <= 0:
+                del others[i]
+                del counts[i]
+        elif delta > 0:
+            others.insert(i, other)
+            counts.insert(i, delta)
+
+    def has_post(self, tag_id, post_id):
+        posts = self.posts_by_tag.get(tag_id, ())
+        i = bisect_left(posts, post_id)
+        return i < len(posts) and posts[i] == post_id
+
+    def related_posts(self, post_id, tag_ids, limit=5):
+        """
+        The ids of up to limit other posts sharing the most of the tag ids with the post, most shared first, then newest first.
+        Candidates are the newest CANDIDATES_PER_TAG posts of each tag, and each is scored with a binary search per tag.
+        """
+        with self.lock:
+            candidates = set()
+            for tag_id in tag_ids:
+                candidates.update(self.posts_by_tag.get(tag_id, ())[-CANDIDATES_PER_TAG:])
+            candidates.discard(post_id)
+
+            scored = [(sum(self.has_post(tag_id, candidate) for tag_id in tag_ids), candidate) for candidate in candidates]
+        scored.sort(reverse=True)
+        return [candidate for _, candidate in scored[:limit]]
+
+    def related_tags(self, tag_ids, limit=5):
+        """
+        The ids of up to limit tags, other than the ones passed, that are most often used on the same posts as them.
+        Reads one row of the co-occurrence matrix per tag.
+        """
+        totals = Counter()
+        with self.lock:
+            for tag_id in tag_ids:
+                others, counts = self.cooccurrence.get(tag_id, ((), ()))
+                totals.update(dict(zip(others, counts)))
+        for tag_id in tag_ids:
+            totals.pop(tag_id, None)
+        return [tag_id for tag_id, _ in sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+class RelatedIndex:
+    """
+    A process-wide TagLinks, for the related posts and related tags on the post page, without joining posts_tags to itself.
+    Loaded on first use with the load function, which returns (post_id, tag_id) rows ordered by post id.
+    This process's own writes are applied with change() when they commit; other processes' writes are picked up
+    when it's reloaded, every ttl seconds. Reloading reads the whole posts_tags table, so the ttl is long,
+    and only one caller at a time reloads: the others keep using the expired links meanwhile,
+    and only wait when there are none yet.
+    """
+
+    def __init__(self, load, ttl=600):
+        self._load = load
+        self.ttl = ttl
+        self._links = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.generation = 0
+
+    def configure(self, ttl):
+        """Change the time to live. Clears the index."""
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        """Expire the links, so the next lookup reloads them. Lookups made during the reload still use them."""
+        with self._lock:
+            self.generation += 1
+            if self._links is not None:
+                self._links.expires_at = 0
+
+    def current(self):
+        """The loaded TagLinks, or None if they haven't been loaded or have expired."""
+        links = self._links
+        if links is not None and links.expires_at > time.monotonic():
+            return links
+        return None
+
+    def build(self, rows, generation):
+        """
+        Build TagLinks from rows read after the generation passed, and keep them if nothing changed in the meantime.
+        Links loaded while a change was committed are used once but not kept, like the tag registry's snapshots.
+        """
+        links = TagLinks(rows, time.monotonic() + self.ttl, self._lock)
+        with self._lock:
+            if generation == self.generation:
+                self._links = links
+        return links
+
+    def links(self):
+        """The current TagLinks, loading them if need be, or the expired ones if another thread is already reloading them."""
+        links = self.current()
+        if links is not None:
+            return links
+
+        expired = self._links
+        if not self._reload_lock.acquire(blocking=expired is None):
+            return expired
+        try:
+            # Another thread may have finished loading them while we waited
+            links = self.current()
+            if links is None:
+                generation = self.generation
+                links = self.build(self._load(), generation)
+            return links
+        finally:
+            self._reload_lock.release()
+
+    async def links_async(self, load):
+        """
+        links() for asyncio, with the rows from the coroutine function load.
+        Waiting for another reload and building the TagLinks run in the default executor, so the event loop isn't held up.
+        """
+        links = self.current()
+        if links is not None:
+            return links
+
+        loop = asyncio.get_running_loop()
+        expired = self._links
+        if expired is not None:
+            if not self._reload_lock.acquire(blocking=False):
+                return expired
+        else:
+            await loop.run_in_executor(None, self._reload_lock.acquire)
+        try:
+            links = self.current()
+            if links is None:
+                generation = self.generation
+                rows = await load()
+                links = await loop.run_in_executor(None, self.build, rows, generation)
+            return links
+        finally:
+            self._reload_lock.release()
+
+    def change(self, post_id, after):
+        """
+        Apply a committed change to a post's tags, giving it the tag ids in after.
+        Changes made before the links are loaded are already in the table, and applying them again changes nothing.
+        """
+        with self._lock:
+            self.generation += 1
+            links = self._links
+        if links is not None:
+            links.change(post_id, set(after))
@@ -0,0 +1,95 @@
+"""
+Send the reads of GET requests to read replicas, and everything else to the primary.
+
+Replicas are listed in the REPLICA_DATABASE_URIS config value and become Flask-SQLAlchemy binds named replica_0, replica_1, ...
+Each GET or HEAD request picks one replica and reads from it for the whole request.
+Writes always go to the primary, whatever the request method.
+
+Replicas lag behind the primary, so after a request commits a write we send a cookie that keeps that client on the primary
+for REPLICA_STICKY_SECONDS. The redirect that follows a form submission then shows the change it just made.
+Other clients may see the old rows until the replicas catch up.
+"""
+import random
+import time
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+STICKY_COOKIE = 'blogly_primary_until'
+
+# When this process last committed a write, so we can tell whether the replicas may not have caught up with it yet
+last_write = 0.0
+
+class RoutingSession(SignallingSession):
+    """
+    A session that reads from the replica bind named in info['replica'], if there is one.
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif self.info.get('replica'):
+            self.info['read_replica'] = True
+            return get_state(self.app).db.get_engine(self.app, bind=self.info['replica'])
+        return super().get_bind(mapper, clause)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_write(session):
+    """Note that a write was committed, so the client that made it can be kept on the primary for a while."""
+    global last_write
+    if session.info.pop('wrote', False):
+        last_write = time.monotonic()
+        if has_request_context():
+            g.db_wrote = True
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_write(session):
+    session.info.pop('wrote', None)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with a RoutingSession as the session class."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def replica_keys(app):
+    return [key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith('replica_')]
+
+def read_from_replica():
+    """Before a request: point the session at a random replica if this is a read and the client isn't stuck to the primary."""
+    keys = replica_keys(current_app)
+    if not keys or request.method not in ('GET', 'HEAD'):
+        return
+
+    if request.cookies.get(STICKY_COOKIE, type=float, default=0) > time.time():
+        return
+
+    get_state(current_app).db.session.info['replica'] = random.choice(keys)
+
+def stick_to_primary(response):
+    """After a request that committed a write, keep the client on the primary until the replicas should have caught up."""
+    if g.pop('db_wrote', False) and replica_keys(current_app):
+        seconds = current_app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+    return response
+
+def may_be_stale():
+    """
+    Whether the current request read from a replica soon enough after a write that the replica may not have had it yet.
+    Pages like that shouldn't be kept in the page cache, since the write's invalidation has already happened.
+    """
+    session = get_state(current_app).db.session
+    return bool(session.info.get('read_replica')) and time.monotonic() - last_write < current_app.config['REPLICA_STICKY_SECONDS']
+
+def init_app(app):
+    """Register the replicas as binds, and the hooks that route each request. Call before connect_db."""
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for n, uri in enumerate(app.config.get('REPLICA_DATABASE_URIS') or ()):
+        binds[f'replica_{n}'] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+    app.before_request(read_from_replica)
+    app.after_request(stick_to_primary)
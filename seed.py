@@ -1,43 +1,218 @@
-from models import User, Post, db, Tag, PostTag
-from app import app
+"""
+Seed the blogly database.
 
-# Drop tables if they already exist, and then create them again
-db.drop_all()
-db.create_all()
+With no arguments, drop and recreate the tables and add a few demo users, posts and tags.
 
-# Delete all entries if there are any
-User.query.delete()
-PostTag.query.delete()
-Post.query.delete()
-Tag.query.delete()
+With --users, generate a large dataset for performance testing instead, e.g.
+    python seed.py --users 1e6 --posts-per-user 20 --tags 5000
+The data only depends on the arguments and --seed, so two runs with the same arguments build the same database.
+Rows are written with multi-row Core INSERTs, one transaction per batch of users (with their posts and tag links),
+so an interrupted run can be picked up again by running the same command: it carries on after the last batch it committed.
+Pass --reset to drop and recreate the tables first.
+"""
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from models import User, Post, db, Tag, PostTag, adjust_post_counts, repair_post_counts, reset_sequences, make_excerpt
+from app import create_app
 
+# Rows per INSERT statement, which keeps us under the bind parameter limits of both Postgres and SQLite
+INSERT_CHUNK_SIZE = 500
 
-# Seed some users
-matty = User(first_name='Matthew', last_name='Yglesias', image='https://static01.nyt.com/images/2020/07/30/books/review/Salmon1/Salmon1-superJumbo.jpg?quality=90&auto=webp')
-cher = User(first_name='Cher', image='https://i.guim.co.uk/img/media/34deec3b589c8b2d4e3aeb135d6be1f36393ccf6/0_4_2118_1270/master/2118.jpg?width=1300&quality=45&auto=format&fit=max&dpr=2&s=f43d40b80eb2611f61c8be5af24d7c44')
-dev = User(first_name='Devlin', last_name='Brush')
+WORDS = ('blog', 'coffee', 'garden', 'music', 'politics', 'travel', 'code', 'bread', 'film', 'books',
+         'running', 'cats', 'dogs', 'history', 'science', 'weather', 'jazz', 'art', 'food', 'news')
 
-# Commit users first 
-db.session.add_all([matty, cher, dev])
-db.session.commit()
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn')
 
-#Seed posts
-post1 = Post(title="1 Billion Americans", content="There should be a lot of Americans. Slow boring is the name of my blog. It's ya boi Matt.", user_id=1)
-post2 = Post(title="Do you Believe?", content="In life after love. I can feel something inside myself.", user_id=2)
-post3 = Post(title="I'm back.", content="It's me, Matt, and I'm back again. Legend in the blog game. Vox is weak.", user_id=1)
+LAST_NAMES = ('Smith', 'Garcia', 'Chen', 'Okafor', 'Novak', 'Silva', 'Kim', 'Brown', 'Ivanova', 'Singh')
 
-#Commit posts
-db.session.add_all([post1, post2, post3])
-db.session.commit()
+EPOCH = datetime(2020, 1, 1)
 
-#Seed some tags and append posts
-politics = Tag(name="politics")
-politics.posts.append(post1)
-politics.posts.append(post3)
+def seed_demo():
+    """Drop and recreate the tables, and add a few demo users, posts and tags."""
+    db.drop_all()
+    db.create_all()
 
-music = Tag(name="music")
-music.posts.append(post2)
+    # Seed some users
+    matty = User(first_name='Matthew', last_name='Yglesias', image='https://static01.nyt.com/images/2020/07/30/books/review/Salmon1/Salmon1-superJumbo.jpg?quality=90&auto=webp')
+    cher = User(first_name='Cher', image='https://i.guim.co.uk/img/media/34deec3b589c8b2d4e3aeb135d6be1f36393ccf6/0_4_2118_1270/master/2118.jpg?width=1300&quality=45&auto=format&fit=max&dpr=2&s=f43d40b80eb2611f61c8be5af24d7c44')
+    dev = User(first_name='Devlin', last_name='Brush')
 
-#Commit tags
-db.session.add_all([politics, music])
-db.session.commit()
\ No newline at end of file
+    # Commit users first
+    db.session.add_all([matty, cher, dev])
+    db.session.commit()
+
+    #Seed posts
+    post1 = Post(title="1 Billion Americans", content="There should be a lot of Americans. Slow boring is the name of my blog. It's ya boi Matt.", user_id=1)
+    post2 = Post(title="Do you Believe?", content="In life after love. I can feel something inside myself.", user_id=2)
+    post3 = Post(title="I'm back.", content="It's me, Matt, and I'm back again. Legend in the blog game. Vox is weak.", user_id=1)
+
+    #Commit posts
+    db.session.add_all([post1, post2, post3])
+    db.session.commit()
+
+    #Seed some tags and append posts
+    politics = Tag(name="politics")
+    politics.posts.append(post1)
+    politics.posts.append(post3)
+
+    music = Tag(name="music")
+    music.posts.append(post2)
+
+    #Commit tags
+    db.session.add_all([politics, music])
+    db.session.commit()
+
+    # Posts and tags were linked through the ORM above, so fill in the post counts they imply
+    repair_post_counts()
+
+def insert_rows(table, rows):
+    """Insert the rows with multi-row INSERT ... VALUES statements, without committing."""
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(table.insert().values(rows[start:start + INSERT_CHUNK_SIZE]))
+
+def tag_name(n):
+    """The unique name of the nth generated tag."""
+    return f'{WORDS[n % len(WORDS)]}-{n}'
+
+def seed_tags(tags, seed):
+    """Insert generated tags with ids 1 to tags, skipping any a previous run already committed."""
+    done = db.session.query(db.func.max(Tag.id)).scalar() or 0
+    rng = random.Random(f'{seed}:tags')
+    rows = [
+        {'id': n, 'name': tag_name(n), 'post_count': 0, 'updated_at': EPOCH + timedelta(minutes=rng.randrange(10 ** 6))}
+        for n in range(done + 1, tags + 1)
+    ]
+    insert_rows(Tag.__table__, rows)
+    db.session.commit()
+
+def generate_batch(first_user, last_user, posts_per_user, tags, max_tags_per_post, seed):
+    """
+    Build the user, post and posts_tags rows for users first_user to last_user.
+    The random generator is seeded from the batch itself, so a batch comes out the same whether or not earlier batches ran in this process.
+    Post ids are assigned up front from the user id, so they're stable too.
+    """
+    rng = random.Random(f'{seed}:users:{first_user}')
+    users, posts, post_tags = [], [], []
+
+    for user_id in range(first_user, last_user + 1):
+        joined = EPOCH + timedelta(minutes=rng.randrange(10 ** 6))
+        users.append({
+            'id': user_id,
+            'first_name': rng.choice(FIRST_NAMES),
+            'last_name': rng.choice(LAST_NAMES),
+            'updated_at': joined,
+            'post_count': posts_per_user
+        })
+
+        for n in range(posts_per_user):
+            post_id = (user_id - 1) * posts_per_user + n + 1
+            created = joined + timedelta(minutes=rng.randrange(10 ** 5))
+            words = [rng.choice(WORDS) for _ in range(rng.randint(20, 120))]
+            content = ' '.join(words)
+            posts.append({
+                'id': post_id,
+                'user_id': user_id,
+                'title': ' '.join(words[:rng.randint(2, 6)]).capitalize(),
+                'content': content,
+                'excerpt': make_excerpt(content),
+                'created_at': created,
+                'updated_at': created
+            })
+
+            # Squaring the uniform draw skews tag use towards the low ids, so some tags are far more popular than others
+            if tags:
+                picked = {int(tags * rng.random() ** 2) + 1 for _ in range(rng.randint(0, max_tags_per_post))}
+                post_tags.extend({'post_id': post_id, 'tag_id': tag_id} for tag_id in picked)
+
+    return users, posts, post_tags
+
+def seed_bulk(users, posts_per_user, tags, max_tags_per_post=5, seed=0, batch_users=1000, progress=None):
+    """
+    Generate users with posts_per_user posts each and tags tags, committing one batch of batch_users users at a time.
+    Carries on after the last committed batch if the tables already have some of the rows.
+    progress is called with (users done, users in total) before the first batch and after each one.
+    """
+    db.create_all()
+    seed_tags(tags, seed)
+
+    done = db.session.query(db.func.max(User.id)).scalar() or 0
+    if progress:
+        progress(done, users)
+
+    for first_user in range(done + 1, users + 1, batch_users):
+        last_user = min(first_user + batch_users - 1, users)
+        user_rows, post_rows, post_tag_rows = generate_batch(first_user, last_user, posts_per_user, tags, max_tags_per_post, seed)
+
+        insert_rows(User.__table__, user_rows)
+        insert_rows(Post.__table__, post_rows)
+        insert_rows(PostTag.__table__, post_tag_rows)
+        adjust_post_counts(Tag, Counter(row['tag_id'] for row in post_tag_rows))
+        db.session.commit()
+
+        if progress:
+            progress(last_user, users)
+
+    reset_sequences('users', 'posts', 'tags')
+    db.session.commit()
+
+def print_progress():
+    """
+    Make a progress callback that prints the rate and an estimate of the time left to stderr.
+    The first call says where we're starting from, so a resumed run doesn't count the rows it skipped.
+    """
+    started, start_done = None, 0
+
+    def report(done, total):
+        nonlocal started, start_done
+        if started is None:
+            started, start_done = time.monotonic(), done
+            return
+
+        elapsed = time.monotonic() - started
+        rate = (done - start_done) / elapsed if elapsed else 0
+        left = (total - done) / rate if rate else 0
+        print(f'\r{done:,}/{total:,} users ({rate:,.0f}/s, {left:,.0f}s left)', end='', file=sys.stderr, flush=True)
+        if done == total:
+            print(file=sys.stderr)
+    return report
+
+def count(value):
+    """Parse a count that may be written like 1e6."""
+    return int(float(value))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed the blogly database.')
+    parser.add_argument('--users', type=count, help='generate this many users instead of the demo data')
+    parser.add_argument('--posts-per-user', type=count, default=20)
+    parser.add_argument('--tags', type=count, default=5000)
+    parser.add_argument('--max-tags-per-post', type=count, default=5)
+    parser.add_argument('--seed', type=int, default=0, help='the same seed always generates the same data')
+    parser.add_argument('--batch-users', type=count, default=1000, help='users (with their posts) per transaction')
+    parser.add_argument('--reset', action='store_true', help='drop and recreate the tables first')
+    parser.add_argument('--database-url', help='seed this database instead of the app\'s')
+    args = parser.parse_args(argv)
+
+    config = {'SQLALCHEMY_ECHO': False}
+    if args.database_url:
+        config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    create_app(config)
+
+    if args.users is None:
+        seed_demo()
+        return
+
+    if args.reset:
+        db.drop_all()
+
+    seed_bulk(args.users, args.posts_per_user, args.tags,
+              max_tags_per_post=args.max_tags_per_post,
+              seed=args.seed,
+              batch_users=args.batch_users,
+              progress=print_progress())
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,79 @@
-from unittest import TestCase
-from app import app
-from models import db, User, Post
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipUnless
+from importlib.util import find_spec
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+from app import create_app
+from models import db, tag_registry, related_index, User, Post, Tag, PostTag, repair_post_counts
+from cache import page_cache
+from seed import seed_bulk
+from config import config_from_env, engine_options
+import instrumentation
+from fragments import fragment_cache
+import routing
+from writebehind import write_queue
+from pagination import encode_cursor
 
-app.config['TESTING'] = True
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-app.config['SQLALCHEMY_ECHO'] = False
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'postgresql:///blogly_test',
+    'DEBUG_TB_HOSTS': ['dont-show-debug-toolbar'],
+    'SQLALCHEMY_ECHO': False
+})
 
 db.drop_all()
 db.create_all()
 
+# The async pages need Quart and the asyncio driver for the test database
+ASYNC_DRIVER = 'asyncpg' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql') else 'aiosqlite'
+ASYNC_READY = find_spec('quart') is not None and find_spec(ASYNC_DRIVER) is not None
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements run inside the with block.
+    Yields a list that gets one entry per statement, so tests can assert on len() afterwards.
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+def first_page_link(html):
+    """Pull the URL out of the first pagination link on a page."""
+    href = html.split('class="page-link" href="')[1].split('"')[0]
+    return href.replace('&amp;', '&')
+
+def next_page_link(html):
+    """Pull the URL out of a page's Next link, or None if it's the last page."""
+    if '>Next</a>' not in html:
+        return None
+    href = html.split('>Next</a>')[0].rsplit('href="', 1)[1].split('"')[0]
+    return href.replace('&amp;', '&')
+
 class TestRoutes(TestCase):
 
     def setUp(self):
         """Delete existing users and posts, add a new test user and post to the db, and save the ID to this instance for easy reference"""
+        PostTag.query.delete()
         Post.query.delete()
         User.query.delete()
+        Tag.query.delete()
+        page_cache.clear()
+        tag_registry.clear()
+        related_index.clear()
 
         new_user = User(first_name="Test", last_name="Case")
         db.session.add(new_user)
@@ -23,11 +81,7 @@ class TestRoutes(TestCase):
 
         self.user = new_user
 
-        new_post = Post(title="Blogly", content="Hello there.", user_id = self.user.id)
-        db.session.add(new_post)
-        db.session.commit()
-
-        self.post = new_post
+        self.post = Post.commit_new_post(user_id=self.user.id, title="Blogly", content="Hello there.", tags=[])
 
     def tearDown(self):
         """Rollback any transaction that didn't get committed"""
@@ -105,10 +159,11 @@ class TestRoutes(TestCase):
     def test_add_post(self):
         """
         Test that when we add a post at the POST route and redirect, we see the post appear on the user's details page.
+        Test that a tag value that isn't an id is ignored.
         """
         with app.test_client() as client:
             response = client.post(f'/users/{self.user.id}/posts/new',
-            data={"title":"New Post", "content": "Say hi!"},
+            data={"title":"New Post", "content": "Say hi!", "tag": ["²"]},
             follow_redirects=True)
             html = response.get_data(as_text=True)
 
@@ -141,3 +196,942 @@ class TestRoutes(TestCase):
 
             self.assertEqual(response.status_code, 200)
             self.assertNotIn('Blogly</a>', html)
+
+    def test_users_pagination(self):
+        """
+        Test that the user list is split into pages of the requested size, and that we can follow the cursors forwards and back.
+        Test that a malformed cursor, or one with values of the wrong type for the columns, is a 400.
+        """
+        for n in range(4):
+            db.session.add(User(first_name=f"Paged{n}", last_name="User"))
+        db.session.commit()
+
+        with app.test_client() as client:
+            first = client.get('/users?per_page=2').get_data(as_text=True)
+            self.assertIn("Test Case", first)
+            self.assertIn("Paged0 User", first)
+            self.assertNotIn("Paged1 User", first)
+            self.assertNotIn("Previous", first)
+
+            next_url = first_page_link(first)
+            second = client.get(next_url).get_data(as_text=True)
+            self.assertIn("Paged1 User", second)
+            self.assertIn("Paged2 User", second)
+            self.assertNotIn("Paged0 User", second)
+            self.assertIn("Previous", second)
+
+            prev_url = first_page_link(second)
+            back = client.get(prev_url).get_data(as_text=True)
+            self.assertIn("Test Case", back)
+            self.assertIn("Paged0 User", back)
+
+            bad_resp = client.get('/users?after=not-a-cursor')
+            self.assertEqual(bad_resp.status_code, 400)
+
+            for url, values in [('/users', [{"a": 1}]), ('/users', ["1"]), ('/users', [True]), ('/users', [2 ** 70]),
+                                ('/tags', [5]), ('/posts', [1, 1]), ('/users?sort=popular', [None, 1])]:
+                separator = '&' if '?' in url else '?'
+                response = client.get(f'{url}{separator}after={encode_cursor(values)}')
+                self.assertEqual(response.status_code, 400, (url, values))
+
+    def test_tags_pagination(self):
+        """Test that tags are listed alphabetically a page at a time."""
+        for name in ["delta", "alpha", "charlie", "bravo"]:
+            db.session.add(Tag(name=name))
+        db.session.commit()
+
+        with app.test_client() as client:
+            first = client.get('/tags?per_page=3').get_data(as_text=True)
+            self.assertIn("Alpha", first)
+            self.assertIn("Charlie", first)
+            self.assertNotIn("Delta", first)
+
+            next_url = first_page_link(first)
+            second = client.get(next_url).get_data(as_text=True)
+            self.assertIn("Delta", second)
+            self.assertNotIn("Alpha", second)
+
+    def test_edit_post_tags(self):
+        """
+        Test that editing a post adds the newly checked tags and removes the unchecked ones, ignoring values that aren't ids.
+        Test that the number of queries doesn't depend on how many tags exist.
+        """
+        tags = [Tag(name=f"tag{n}") for n in range(30)]
+        db.session.add_all(tags)
+        db.session.commit()
+        tag_ids = [tag.id for tag in tags]
+        Post.query.get(self.post.id).edit(title="Blogly", content="Hello there.", tags=[str(tag_ids[0]), str(tag_ids[1])])
+
+        post = Post.query.get(self.post.id)
+        with count_queries() as few_tags:
+            post.edit(title="Blogly", content="Hello again.", tags=[str(tag_ids[1]), str(tag_ids[2]), "²"])
+        self.assertEqual({tag.id for tag in Post.query.get(self.post.id).tags}, {tag_ids[1], tag_ids[2]})
+
+        post = Post.query.get(self.post.id)
+        with count_queries() as many_tags:
+            post.edit(title="Blogly", content="Hello once more.", tags=[str(tag_id) for tag_id in tag_ids[3:]])
+        self.assertEqual({tag.id for tag in Post.query.get(self.post.id).tags}, set(tag_ids[3:]))
+
+        self.assertEqual(len(few_tags), len(many_tags))
+        self.assertLessEqual(len(many_tags), 8)
+
+    def test_commit_new_posts(self):
+        """
+        Test that a batch of posts is created with all of their tags, ignoring tag values that aren't ids.
+        Test that the tag relationships are written in one statement however many posts there are.
+        """
+        music = Tag(name="music")
+        politics = Tag(name="politics")
+        db.session.add_all([music, politics])
+        db.session.commit()
+
+        batch = [
+            {"user_id": self.user.id, "title": f"Batch {n}", "content": "Hi.", "tags": [str(music.id), str(politics.id), "nonsense", "²"]}
+            for n in range(10)
+        ]
+        batch.append({"user_id": self.user.id, "title": "Untagged", "content": "Hi."})
+
+        with count_queries() as statements:
+            new_posts = Post.commit_new_posts(batch)
+
+        self.assertEqual([post.title for post in new_posts], [post["title"] for post in batch])
+        self.assertEqual(PostTag.query.count(), 20)
+        self.assertEqual(len([s for s in statements if 'posts_tags' in s]), 1)
+        self.assertEqual(Post.query.get(new_posts[-1].id).tags, [])
+
+    def test_tags_checked_on_primary(self):
+        """Test that writes check tag ids against the database, not a tag registry that hasn't seen another process's new tag."""
+        tag_registry.snapshot()
+        # As another worker would, without clearing this process's registry
+        db.session.execute(Tag.__table__.insert(), [{"name": "elsewhere"}])
+        db.session.commit()
+        tag_id = db.session.query(Tag.id).filter_by(name="elsewhere").scalar()
+        self.assertIsNone(tag_registry.name(tag_id))
+
+        new_post, = Post.commit_new_posts([{"user_id": self.user.id, "title": "Fresh", "content": "Hi.", "tags": [str(tag_id)]}])
+        self.assertEqual([tag.id for tag in Post.query.get(new_post.id).tags], [tag_id])
+
+        Post.query.get(self.post.id).edit(title="Blogly", content="Hello.", tags=[str(tag_id)])
+        self.assertEqual([tag.id for tag in Post.query.get(self.post.id).tags], [tag_id])
+
+    def assertQueryCountFlat(self, url, grow):
+        """
+        Request the URL, call grow() to add more related rows, and request it again.
+        Fail if the second request ran more queries than the first, which means the page has an N+1 problem.
+        Returns the number of queries the page took.
+        """
+        with app.test_client() as client:
+            with count_queries() as before:
+                self.assertEqual(client.get(url).status_code, 200)
+            grow()
+            with count_queries() as after:
+                self.assertEqual(client.get(url).status_code, 200)
+
+        self.assertEqual(len(before), len(after), f"{url} ran {len(after) - len(before)} more queries with more rows")
+        return len(after)
+
+    def test_detail_page_query_counts(self):
+        """Test that the user, post and tag details pages take a fixed number of queries however many posts and tags they show."""
+        tags = [Tag(name=f"tag{n}") for n in range(3)]
+        db.session.add_all(tags)
+        db.session.commit()
+        tag_ids = [str(tag.id) for tag in tags]
+        user_id = self.user.id
+        post = Post.commit_new_post(user_id=user_id, title="Tagged", content="Hi.", tags=tag_ids[:1])
+        post_id, tag_id = post.id, tags[0].id
+
+        def add_posts():
+            Post.commit_new_posts([
+                {"user_id": user_id, "title": f"More {n}", "content": "Hi.", "tags": tag_ids}
+                for n in range(10)
+            ])
+
+        def add_tags():
+            Post.query.get(post_id).edit(title="Tagged", content="Hi.", tags=tag_ids)
+
+        # One query for the conditional request check, then the row and its related rows,
+        # and for a post the titles of its related posts, once the in-memory indexes are loaded
+        self.assertLessEqual(self.assertQueryCountFlat(f'/users/{user_id}', add_posts), 3)
+        self.assertLessEqual(self.assertQueryCountFlat(f'/tags/{tag_id}', add_posts), 3)
+        related_index.links()
+        tag_registry.snapshot()
+        self.assertLessEqual(self.assertQueryCountFlat(f'/posts/{post_id}', add_tags), 4)
+
+    def test_delete_cascades(self):
+        """
+        Test that deleting a user removes their posts and those posts' tag relationships in a fixed number of statements.
+        Test that deleting a tag removes its relationships but leaves the posts.
+        """
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        tag_id, user_id = music.id, self.user.id
+        posts = Post.commit_new_posts([
+            {"user_id": user_id, "title": f"Post {n}", "content": "Hi.", "tags": [str(tag_id)]}
+            for n in range(20)
+        ])
+        post_id = posts[0].id
+
+        with app.test_client() as client:
+            client.post(f'/tags/{tag_id}/delete')
+            self.assertEqual(PostTag.query.count(), 0)
+            self.assertIsNotNone(Post.query.get(post_id))
+
+            with count_queries() as statements:
+                response = client.post(f'/users/{user_id}/delete')
+
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(Post.query.count(), 0)
+            self.assertLessEqual(len(statements), 2)
+
+    def test_page_cache(self):
+        """
+        Test that a repeated page view is served from the cache without touching the DB.
+        Test that editing the user, renaming a tag on their post, and adding a post each invalidate the pages that showed them.
+        """
+        user_id, post_id = self.user.id, self.post.id
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        tag_id = music.id
+
+        with app.test_client() as client:
+            client.post(f'/posts/{post_id}/edit', data={"title": "Blogly", "content": "Hello there.", "tag": [str(tag_id)]})
+            client.get(f'/users/{user_id}')
+            client.get(f'/posts/{post_id}')
+
+            hits = page_cache.stats()['hits']
+            # Only the cheap version check for conditional requests should reach the DB
+            with count_queries() as statements:
+                client.get(f'/users/{user_id}')
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(page_cache.stats()['hits'], hits + 1)
+
+            client.post(f'/users/{user_id}/edit', data={"first": "Renamed", "last": "", "image": ""})
+            self.assertIn("Renamed Case", client.get(f'/users/{user_id}').get_data(as_text=True))
+            self.assertIn("By Renamed Case", client.get(f'/posts/{post_id}').get_data(as_text=True))
+
+            client.post(f'/tags/{tag_id}/edit', data={"name": "jazz"})
+            self.assertIn(">jazz</span>", client.get(f'/posts/{post_id}').get_data(as_text=True))
+
+            client.post(f'/users/{user_id}/posts/new', data={"title": "Fresh Post", "content": "New!"})
+            self.assertIn("Fresh Post", client.get(f'/users/{user_id}').get_data(as_text=True))
+
+            stats = client.get('/cache/stats').get_json()
+            self.assertGreater(stats['hits'], 0)
+            self.assertGreater(stats['misses'], 0)
+
+    def test_conditional_requests(self):
+        """
+        Test that the details pages send an ETag and Last-Modified, and answer a matching If-None-Match with an empty 304.
+        Test that editing the post gives it a new ETag, and that a missing post is still a 404.
+        """
+        post_id, user_id = self.post.id, self.user.id
+
+        with app.test_client() as client:
+            response = client.get(f'/posts/{post_id}')
+            etag = response.headers['ETag']
+            self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+            not_modified = client.get(f'/posts/{post_id}', headers={"If-None-Match": etag})
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.get_data(), b'')
+
+            last_modified = client.get(f'/users/{user_id}').headers['Last-Modified']
+            since = client.get(f'/users/{user_id}', headers={"If-Modified-Since": last_modified})
+            self.assertEqual(since.status_code, 304)
+
+            client.post(f'/posts/{post_id}/edit', data={"title": "Changed", "content": "Hello there."})
+            changed = client.get(f'/posts/{post_id}', headers={"If-None-Match": etag})
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.headers['ETag'], etag)
+
+            self.assertEqual(client.get('/posts/100000').status_code, 404)
+
+    def test_last_modified_after_deletes(self):
+        """
+        Test that deleting a post, deleting a tag, or taking a tag off a post moves the Last-Modified of the pages that listed them,
+        so If-Modified-Since alone doesn't get a stale 304.
+        """
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        tag_id, user_id = music.id, self.user.id
+        Post.commit_new_posts([
+            {"user_id": user_id, "title": f"Song {n}", "content": "La la.", "tags": [str(tag_id)]}
+            for n in range(3)
+        ])
+        first, second, third = [post_id for post_id, in db.session.query(Post.id).filter(Post.title.like('Song%')).order_by(Post.id)]
+
+        def since(path):
+            """Age every row, so the change below is the latest, and get the path with its Last-Modified."""
+            for model in (User, Post, Tag):
+                model.query.update({model.updated_at: datetime(2000, 1, 1)}, synchronize_session = False)
+            db.session.commit()
+            page_cache.clear()
+            last_modified = client.get(path).headers['Last-Modified']
+            self.assertEqual(client.get(path, headers={"If-Modified-Since": last_modified}).status_code, 304)
+            return {"If-Modified-Since": last_modified}
+
+        with app.test_client() as client:
+            headers = since(f'/users/{user_id}')
+            client.post(f'/posts/{first}/delete')
+            self.assertEqual(client.get(f'/users/{user_id}', headers=headers).status_code, 200)
+
+            headers = since(f'/tags/{tag_id}')
+            client.post(f'/posts/{second}/edit', data={"title": "Song", "content": "La la."})
+            self.assertEqual(client.get(f'/tags/{tag_id}', headers=headers).status_code, 200)
+
+            headers = since(f'/posts/{third}')
+            client.post(f'/tags/{tag_id}/delete')
+            self.assertEqual(client.get(f'/posts/{third}', headers=headers).status_code, 200)
+
+    def test_api(self):
+        """
+        Test that the collection endpoints stream one JSON object per line, and the single resource endpoints return JSON.
+        Test that a missing resource is a 404.
+        """
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        tag_id, user_id = music.id, self.user.id
+        Post.commit_new_posts([
+            {"user_id": user_id, "title": f"Song {n}", "content": "La la.", "tags": [str(tag_id)]}
+            for n in range(3)
+        ])
+
+        with app.test_client() as client:
+            response = client.get('/api/users')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            users = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual([user["first_name"] for user in users], ["Test"])
+
+            response = client.get(f'/api/tags/{tag_id}/posts')
+            posts = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual([post["title"] for post in posts], ["Song 0", "Song 1", "Song 2"])
+
+            user = client.get(f'/api/users/{user_id}').get_json()
+            self.assertEqual(user["post_count"], 4)
+            self.assertNotIn("posts", user)
+
+            post = client.get(f'/api/posts/{posts[0]["id"]}').get_json()
+            self.assertEqual(post["tags"], [{"id": tag_id, "name": "music"}])
+
+            self.assertEqual(client.get('/api/posts/100000').status_code, 404)
+            self.assertEqual(client.get('/api/tags/100000/posts').status_code, 404)
+
+    def test_search(self):
+        """
+        Test that search finds posts by words in their title or content, ranking title matches first.
+        Test that edited and deleted posts are kept in step with the search index, and that the results are paged,
+        up to a maximum page.
+        """
+        user_id = self.user.id
+        in_content, in_title, other = [post.id for post in Post.commit_new_posts([
+            {"user_id": user_id, "title": "Weekend", "content": "We went to see the giraffes at the zoo."},
+            {"user_id": user_id, "title": "Giraffes are tall", "content": "Really quite tall."},
+            {"user_id": user_id, "title": "Bread", "content": "Sourdough again."}
+        ])]
+
+        with app.test_client() as client:
+            html = client.get('/search?q=giraffes').get_data(as_text=True)
+            self.assertIn("Weekend", html)
+            self.assertLess(html.index("Giraffes are tall"), html.index("Weekend"))
+            self.assertNotIn("Bread</a>", html)
+
+            client.post(f'/posts/{other}/edit', data={"title": "Bread", "content": "Fed some to the giraffes."})
+            client.post(f'/posts/{in_title}/delete')
+            html = client.get('/search?q=giraffes').get_data(as_text=True)
+            self.assertIn("Bread</a>", html)
+            self.assertNotIn("Giraffes are tall", html)
+
+            first = client.get('/search?q=giraffes&per_page=1').get_data(as_text=True)
+            self.assertIn("Next", first)
+            second = client.get(first_page_link(first)).get_data(as_text=True)
+            self.assertIn("Previous", second)
+
+            self.assertIn("No posts matched", client.get('/search?q=%22unicorns').get_data(as_text=True))
+
+            self.assertEqual(client.get('/search?q=giraffes&page=99999999999999999999999').status_code, 400)
+
+    def test_post_counts(self):
+        """
+        Test that user and tag post counts follow posts being added, retagged and deleted, and users being deleted.
+        Test that the lists can be sorted by post count, and that repair-counts fixes counts that have drifted.
+        """
+        music, politics = Tag(name="music"), Tag(name="politics")
+        other = User(first_name="Other", last_name="Person")
+        db.session.add_all([music, politics, other])
+        db.session.commit()
+        music_id, politics_id, other_id, user_id = music.id, politics.id, other.id, self.user.id
+
+        def counts():
+            db.session.expire_all()
+            return (User.query.get(user_id).post_count, User.query.get(other_id).post_count,
+                    Tag.query.get(music_id).post_count, Tag.query.get(politics_id).post_count)
+
+        self.assertEqual(counts(), (1, 0, 0, 0))
+
+        posts = Post.commit_new_posts([
+            {"user_id": user_id, "title": "Song", "content": "La.", "tags": [str(music_id), str(politics_id)]},
+            {"user_id": other_id, "title": "Vote", "content": "Go.", "tags": [str(politics_id)]},
+            {"user_id": other_id, "title": "Again", "content": "Go.", "tags": [str(politics_id)]}
+        ])
+        song_id, vote_id = posts[0].id, posts[1].id
+        self.assertEqual(counts(), (2, 2, 1, 3))
+
+        Post.query.get(vote_id).edit(title="Vote", content="Go.", tags=[str(music_id)])
+        self.assertEqual(counts(), (2, 2, 2, 2))
+
+        with app.test_client() as client:
+            client.post(f'/posts/{song_id}/delete')
+            self.assertEqual(counts(), (1, 2, 1, 1))
+
+            html = client.get('/users?sort=popular').get_data(as_text=True)
+            self.assertLess(html.index("Other Person"), html.index("Test Case"))
+            self.assertIn("2 posts", html)
+
+            client.post(f'/users/{other_id}/delete')
+            self.assertEqual(Tag.query.get(music_id).post_count, 0)
+            self.assertEqual(Tag.query.get(politics_id).post_count, 0)
+
+        Tag.query.filter_by(id=music_id).update({"post_count": 7})
+        User.query.filter_by(id=user_id).update({"post_count": 0})
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["repair-counts"])
+        self.assertIn("Fixed post counts for 1 users and 1 tags", result.output)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(user_id).post_count, 1)
+        self.assertEqual(Tag.query.get(music_id).post_count, 0)
+
+    def test_seed_bulk(self):
+        """
+        Test that the bulk seeder writes the rows asked for with consistent post counts.
+        Test that running it again resumes rather than duplicating rows, and that the same seed gives the same data.
+        """
+        def clear():
+            PostTag.query.delete()
+            Post.query.delete()
+            User.query.delete()
+            Tag.query.delete()
+            db.session.commit()
+
+        def snapshot():
+            return [(post.id, post.user_id, post.title) for post in Post.query.order_by(Post.id)]
+
+        clear()
+        seen = []
+        seed_bulk(users=5, posts_per_user=3, tags=4, seed=7, batch_users=2, progress=lambda done, total: seen.append(done))
+
+        self.assertEqual(seen, [0, 2, 4, 5])
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Post.query.count(), 15)
+        self.assertEqual(Tag.query.count(), 4)
+        self.assertEqual(repair_post_counts(), (0, 0))
+        first_run = snapshot()
+
+        seed_bulk(users=5, posts_per_user=3, tags=4, seed=7, batch_users=2)
+        self.assertEqual(Post.query.count(), 15)
+
+        clear()
+        seed_bulk(users=5, posts_per_user=3, tags=4, seed=7, batch_users=2)
+        self.assertEqual(snapshot(), first_run)
+
+    def test_metrics(self):
+        """
+        Test that requests are counted with their SQL statements in /metrics, in Prometheus text format,
+        and that each response says where its time went in a Server-Timing header.
+        Test that statements over the slow query threshold are logged.
+        """
+        with app.test_client() as client:
+            response = client.get('/users')
+            self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+            text = client.get('/metrics').get_data(as_text=True)
+            self.assertIn('# TYPE blogly_requests_total counter', text)
+            self.assertIn('blogly_requests_total{endpoint="blogly.show_users",method="GET",status="200"}', text)
+            self.assertIn('blogly_request_sql_statements_count{endpoint="blogly.show_users"}', text)
+            self.assertIn('blogly_page_cache_misses', text)
+
+            threshold = instrumentation.slow_query_seconds
+            instrumentation.slow_query_seconds = 0
+            try:
+                with self.assertLogs('blogly.sql', level='WARNING') as logs:
+                    client.get(f'/users/{self.user.id}/edit')
+            finally:
+                instrumentation.slow_query_seconds = threshold
+            self.assertIn('Slow query', logs.output[0])
+            self.assertIn('show_user_edit_form', logs.output[0])
+
+    def test_shared_metrics(self):
+        """
+        Test that with a metrics directory, /metrics adds other workers' snapshots to this process's counts,
+        including two workers that had the same pid, and that once a worker has exited its counters are kept
+        but its page cache stats aren't.
+        """
+        other = instrumentation.Metrics()
+        labels = (('endpoint', 'blogly.show_users'), ('method', 'GET'), ('status', 200))
+        other.inc('blogly_requests_total', labels, amount=5)
+        other.observe('blogly_request_duration_seconds', 0.01, labels[:1])
+        requests = 'blogly_requests_total{endpoint="blogly.show_users",method="GET",status="200"} 11'
+
+        with tempfile.TemporaryDirectory() as tmp, app.test_client() as client:
+            for started in (100, 200):
+                with open(os.path.join(tmp, f'metrics-1-{started}.json'), 'w') as file:
+                    json.dump(dict(other.snapshot(), page_cache={'size': 500000}), file)
+
+            instrumentation.metrics.reset()
+            instrumentation.metrics_dir = tmp
+            try:
+                client.get('/users')
+                text = client.get('/metrics').get_data(as_text=True)
+                self.assertIn(requests, text)
+                self.assertIn('blogly_request_duration_seconds_count{endpoint="blogly.show_users"} 3', text)
+                self.assertIn('# HELP blogly_requests_total', text)
+                self.assertRegex(text, r'blogly_page_cache_size 100\d{4}\n')
+
+                instrumentation.mark_process_dead(tmp, 1)
+                text = client.get('/metrics').get_data(as_text=True)
+                self.assertIn(requests, text)
+                self.assertRegex(text, r'blogly_page_cache_size \d{1,4}\n')
+            finally:
+                instrumentation.metrics_dir = None
+
+    def test_config_from_env(self):
+        """
+        Test that the pool settings come from the environment, that a connection budget is split between the workers,
+        and that they're only passed to the engine for databases with a queue pool.
+        """
+        config = config_from_env({'DATABASE_URL': 'postgres://db.example.com/blogly', 'DB_POOL_SIZE': '8', 'DB_POOL_RECYCLE': '300'})
+        self.assertEqual(config['SQLALCHEMY_DATABASE_URI'], 'postgresql://db.example.com/blogly')
+        options = engine_options(config)
+        self.assertEqual(options['pool_size'], 8)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertEqual(options['pool_recycle'], 300)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertNotIn('options', options['connect_args'])
+
+        config = config_from_env({'DATABASE_URL': 'postgresql:///blogly', 'DB_MAX_CONNECTIONS': '100', 'WEB_CONCURRENCY': '4',
+                                  'DB_STATEMENT_TIMEOUT_MS': '5000', 'DB_POOL_PRE_PING': '0'})
+        options = engine_options(config)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (25, 0))
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args']['options'], '-c statement_timeout=5000')
+
+        self.assertEqual(engine_options(config_from_env({'DATABASE_URL': 'sqlite:///blogly.db'})), {})
+
+    def test_read_replicas(self):
+        """
+        Test that with a replica configured, form posts write to the primary and GET requests read from the replica,
+        except for a client that just wrote something, which reads from the primary until the replica should have caught up.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            primary, replica = (f'sqlite:///{os.path.join(tmp, name)}.db' for name in ('primary', 'replica'))
+            routed = create_app({
+                'TESTING': True,
+                'SQLALCHEMY_DATABASE_URI': primary,
+                'REPLICA_DATABASE_URIS': [replica],
+                'SQLALCHEMY_ECHO': False
+            })
+            db.session.remove()
+            try:
+                replica_engine = db.get_engine(routed, 'replica_0')
+                db.create_all()
+                db.Model.metadata.create_all(replica_engine)
+
+                with routed.test_client() as writer:
+                    response = writer.post('/users/new', data={"first": "Fresh", "last": "Writer", "image": ""})
+                    self.assertIn(routing.STICKY_COOKIE, response.headers['Set-Cookie'])
+                    self.assertEqual(replica_engine.execute(db.select([db.func.count(User.id)])).scalar(), 0)
+
+                    with routed.test_client() as reader:
+                        self.assertNotIn("Fresh Writer", reader.get('/users').get_data(as_text=True))
+                    self.assertIn("Fresh Writer", writer.get('/users').get_data(as_text=True))
+
+                page_cache.clear()
+                replica_engine.execute(User.__table__.insert(), {'first_name': 'Replicated', 'last_name': 'Row'})
+                with routed.test_client() as reader:
+                    html = reader.get('/users').get_data(as_text=True)
+                self.assertIn("Replicated Row", html)
+                self.assertNotIn("Fresh Writer", html)
+            finally:
+                db.session.remove()
+                db.app = app
+
+    @skipUnless(ASYNC_READY, f'needs quart and {ASYNC_DRIVER}')
+    def test_async_pages(self):
+        """
+        Test that the async app renders the read pages exactly like the sync app, paginates the same way,
+        and answers conditional requests and missing rows the same way.
+        """
+        from async_app import create_async_app
+
+        music = Tag(name="music")
+        db.session.add_all([music, User(first_name="Second", last_name="User")])
+        db.session.commit()
+        user_id, post_id, tag_id = self.user.id, self.post.id, music.id
+
+        urls = ['/users', '/users?sort=popular&per_page=1', f'/users/{user_id}', '/posts', '/posts?per_page=1', '/posts?tags=music,unknown&mode=any', '/tags', '/tags?sort=popular']
+        with app.test_client() as client:
+            client.post(f'/posts/{post_id}/edit', data={"title": "Blogly", "content": "Hello there.", "tag": [str(tag_id)]})
+            urls += [f'/posts/{post_id}', f'/tags/{tag_id}', first_page_link(client.get('/users?per_page=1').get_data(as_text=True))]
+            expected = {url: client.get(url).get_data(as_text=True) for url in urls}
+            etag = client.get(f'/posts/{post_id}').headers['ETag']
+
+        async def fetch():
+            async_app = create_async_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI']})
+            async with async_app.test_app() as test_app:
+                client = test_app.test_client()
+                pages = {}
+                for url in urls:
+                    response = await client.get(url)
+                    pages[url] = await response.get_data(as_text=True)
+                cached = await client.get(f'/posts/{post_id}', headers={'If-None-Match': etag})
+                missing = await client.get('/users/0')
+                bad_cursor = await client.get('/users?after=nonsense')
+                bad_value = await client.get(f'/users?after={encode_cursor([{"a": 1}])}')
+                return pages, cached.status_code, missing.status_code, bad_cursor.status_code, bad_value.status_code
+
+        pages, cached, missing, bad_cursor, bad_value = asyncio.run(fetch())
+        for url in urls:
+            self.assertEqual(pages[url], expected[url], url)
+        self.assertEqual((cached, missing, bad_cursor, bad_value), (304, 404, 400, 400))
+
+    def test_tag_registry(self):
+        """
+        Test that the post forms and the tag autocomplete are served from the tag registry without querying the tags table,
+        and that adding, renaming and deleting tags through the write paths updates it.
+        """
+        for name in ("music", "museums", "politics"):
+            Tag.commit_new_tag(name)
+        music_id = tag_registry.find("music")
+        user_id, post_id = self.user.id, self.post.id
+
+        with app.test_client() as client:
+            client.get(f'/users/{user_id}/posts/new')
+            with count_queries() as statements:
+                html = client.get(f'/users/{user_id}/posts/new').get_data(as_text=True)
+                suggestions = json.loads(client.get('/api/tags/autocomplete?q=Mu').get_data(as_text=True))
+            self.assertIn("Politics", html)
+            self.assertFalse([statement for statement in statements if 'FROM tags' in statement])
+            self.assertEqual([tag["name"] for tag in suggestions], ["museums", "music"])
+
+            client.post(f'/posts/{post_id}/edit', data={"title": "Blogly", "content": "Hello there.", "tag": [str(music_id), "9999"]})
+            html = client.get(f'/posts/{post_id}/edit').get_data(as_text=True)
+            self.assertIn(f'value="{music_id}" checked', html)
+
+            client.post(f'/tags/{music_id}/edit', data={"name": "jazz"})
+            Tag.delete_tag(tag_registry.find("museums"))
+            suggestions = json.loads(client.get('/api/tags/autocomplete?q=mu').get_data(as_text=True))
+            self.assertEqual(suggestions, [])
+            self.assertEqual(tag_registry.name(music_id), "jazz")
+            self.assertEqual({tag.id for tag in Post.query.get(post_id).tags}, {music_id})
+
+    def test_fragment_cache(self):
+        """
+        Test that list rows are rendered once and then reused from the fragment cache,
+        that a changed row is rendered again with its new values, and that the values are still escaped.
+        """
+        user_id = self.user.id
+        fragment_cache.clear()
+
+        with app.test_client() as client:
+            client.get('/users')
+            page_cache.clear()
+            hits = fragment_cache.stats()['hits']
+            client.get('/users')
+            self.assertEqual(fragment_cache.stats()['hits'], hits + 1)
+
+            client.post(f'/users/{user_id}/edit', data={"first": "<b>Bold</b>", "last": "", "image": ""})
+            html = client.get('/users').get_data(as_text=True)
+            self.assertIn("&lt;b&gt;Bold&lt;/b&gt; Case", html)
+            self.assertIn('1 post</small>', html)
+
+    def test_recent_posts(self):
+        """
+        Test that the database stamps each post with the time it was inserted,
+        and that the recent posts feed and a user's posts list them newest first, a page at a time.
+        """
+        user_id = self.user.id
+        for n in range(3):
+            Post.commit_new_post(user_id=user_id, title=f"Post {n}", content="Hi.", tags=[])
+        posts = Post.query.filter(Post.user_id == user_id).order_by(Post.id).all()
+        stamps = [post.created_at for post in posts]
+        self.assertEqual(stamps, sorted(stamps))
+        self.assertEqual(len(set(stamps)), len(stamps))
+
+        with app.test_client() as client:
+            html = client.get('/posts').get_data(as_text=True)
+            self.assertLess(html.index("Post 2"), html.index("Post 1"))
+            self.assertIn(f'<a href="/users/{user_id}">Test Case</a>', html)
+
+            titles = []
+            url = '/posts?per_page=1'
+            while url:
+                html = client.get(url).get_data(as_text=True)
+                titles += [post.title for post in posts if f'/posts/{post.id}"' in html]
+                url = next_page_link(html)
+            self.assertEqual(titles, [post.title for post in reversed(posts)])
+
+            html = client.get(f'/users/{user_id}?per_page=2').get_data(as_text=True)
+            self.assertIn("Post 2", html)
+            self.assertNotIn("Post 0", html)
+
+            Post.commit_new_post(user_id=user_id, title="Latest", content="Hi.", tags=[])
+            self.assertIn("Latest", client.get('/posts').get_data(as_text=True))
+
+    def test_import_export(self):
+        """
+        Test that users, posts and tags exported as NDJSON or CSV can be imported into empty tables with the same ids and tag links,
+        that importing the same file again changes nothing, and that tag names that don't exist yet become tags.
+        """
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        user_id, post_id = self.user.id, self.post.id
+        self.post.edit(title="Blogly", content="Hello, there.", tags=[str(music.id)])
+
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = {(kind, format): os.path.join(directory, f'{kind}.{format}') for kind in ('users', 'posts', 'tags') for format in ('ndjson', 'csv')}
+            for (kind, format), path in paths.items():
+                result = runner.invoke(args=['blogly', 'export', kind, path])
+                self.assertIn(f'Exported 1 {kind}', result.output)
+
+            for format in ('ndjson', 'csv'):
+                PostTag.query.delete()
+                Post.query.delete()
+                User.query.delete()
+                Tag.query.delete()
+                db.session.commit()
+
+                for kind in ('users', 'tags', 'posts', 'posts'):
+                    result = runner.invoke(args=['blogly', 'import', kind, paths[(kind, format)]])
+                    self.assertIn(f'Imported 1 {kind}', result.output)
+
+                db.session.expire_all()
+                post = Post.query.get(post_id)
+                self.assertEqual((post.user_id, post.content), (user_id, "Hello, there."))
+                self.assertEqual([tag.name for tag in post.tags], ["music"])
+                self.assertEqual(User.query.get(user_id).post_count, 1)
+                self.assertEqual(Post.query.count(), 1)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as file:
+            file.write(json.dumps({"user_id": user_id, "title": "Imported", "content": "Hi.", "tags": ["Jazz", "music"]}) + '\n')
+        try:
+            runner.invoke(args=['blogly', 'import', 'posts', file.name])
+        finally:
+            os.remove(file.name)
+        imported = Post.query.filter_by(title="Imported").one()
+        self.assertEqual(sorted(tag.name for tag in imported.tags), ["jazz", "music"])
+        self.assertEqual(Tag.query.filter_by(name="music").one().post_count, 2)
+
+    def test_import_bad_records(self):
+        """
+        Test that an import stops with the line of a record that's missing a required field, has a value that doesn't parse,
+        or isn't valid JSON, rather than a traceback, and that the chunks before it are kept.
+        """
+        user_id = self.user.id
+        files = [
+            ('tags', 'ndjson', '{"name": "jazz"}\n{"id": 7}\n', 'Line 2: missing name'),
+            ('posts', 'ndjson', json.dumps({"user_id": user_id, "title": "No content"}) + '\n', 'Line 1: missing content'),
+            ('posts', 'ndjson', '\n{"title": "Untitled",\n', 'Line 2: invalid JSON'),
+            ('posts', 'ndjson', json.dumps({"user_id": "someone", "title": "Hi", "content": "Hi."}) + '\n', "Line 1: invalid user_id 'someone'"),
+            ('users', 'csv', 'first_name,last_name\nAda,Lovelace\n,Nameless\n', 'Line 3: missing first_name')
+        ]
+
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            for kind, format, content, error in files:
+                path = os.path.join(directory, f'{kind}.{format}')
+                with open(path, 'w') as file:
+                    file.write(content)
+                result = runner.invoke(args=['blogly', 'import', kind, path, '--chunk-size', '1'])
+                self.assertEqual(result.exit_code, 1, error)
+                self.assertIn(error, result.output)
+
+        self.assertEqual(Tag.query.filter_by(name="jazz").count(), 1)
+        self.assertEqual(User.query.filter_by(first_name="Ada").count(), 1)
+
+    def test_write_behind(self):
+        """
+        Test that with WRITE_BEHIND on, submissions are queued and then committed together,
+        that a write that fails doesn't lose the others in its batch, and that a full queue answers 503.
+        """
+        post_id = self.post.id
+        settings = {key: app.config[key] for key in ('WRITE_BEHIND', 'WRITE_BATCH_SIZE', 'WRITE_QUEUE_SIZE', 'WRITE_QUEUE_TIMEOUT_MS')}
+        app.config['WRITE_BEHIND'] = True
+        # Other tests build apps of their own, which take over the queue
+        write_queue.configure(app)
+        try:
+            with app.test_client() as client:
+                for n in range(5):
+                    response = client.post('/users/new', data={"first": f"Queued{n}", "last": "", "image": ""})
+                    self.assertEqual(response.status_code, 302)
+                for name in ("twice", "twice", "once"):
+                    client.post('/tags/new', data={"name": name})
+                client.post(f'/posts/{post_id}/edit', data={"title": "Queued edit", "content": "Hi."})
+            write_queue.flush()
+
+            self.assertEqual(User.query.filter(User.first_name.like("Queued%")).count(), 5)
+            self.assertEqual(sorted(name for (name,) in db.session.query(Tag.name)), ["once", "twice"])
+            self.assertEqual(db.session.query(Post.title).filter_by(id=post_id).scalar(), "Queued edit")
+
+            # One write holds up the worker and the next fills the queue, so the one after that is turned away
+            release = threading.Event()
+            def held(commit):
+                release.wait()
+            app.config.update(WRITE_BATCH_SIZE=1, WRITE_QUEUE_SIZE=1, WRITE_QUEUE_TIMEOUT_MS=0)
+            write_queue.configure(app)
+            write_queue.submit(held)
+            while write_queue.pending():
+                time.sleep(0.01)
+            write_queue.submit(held)
+
+            with app.test_client() as client:
+                response = client.post('/tags/new', data={"name": "late"})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            release.set()
+        finally:
+            app.config.update(settings)
+            write_queue.configure(app)
+
+    def test_post_excerpts(self):
+        """
+        Test that a post's excerpt follows its content through create and edit, cut at a word break when the content is long,
+        and that the list pages show it without ever selecting the content.
+        """
+        music = Tag(name="music")
+        db.session.add(music)
+        db.session.commit()
+        user_id, tag_id = self.user.id, music.id
+        self.assertEqual(self.post.excerpt, "Hello there.")
+
+        long_post = Post.commit_new_post(user_id=user_id, title="Long", content="word " * 1000, tags=[str(tag_id)])
+        self.assertEqual(long_post.excerpt, ("word " * 40).strip() + "…")
+        long_post.edit(title="Long", content="Short  now.\n", tags=[str(tag_id)])
+        self.assertEqual(Post.query.get(long_post.id).excerpt, "Short now.")
+
+        with app.test_client() as client:
+            for url in [f'/users/{user_id}', '/posts', f'/tags/{tag_id}']:
+                with count_queries() as statements:
+                    html = client.get(url).get_data(as_text=True)
+                self.assertIn("Short now.", html, url)
+                self.assertFalse([statement for statement in statements if 'posts.content' in statement], url)
+            self.assertIn("Short  now.", client.get(f'/posts/{long_post.id}').get_data(as_text=True))
+
+    def test_related_posts(self):
+        """
+        Test that the post page lists the posts sharing the most tags with it, and the tags most used alongside its tags,
+        and that the index behind them keeps up with tags being attached and detached, posts being deleted and tags being deleted.
+        """
+        tags = [Tag(name=name) for name in ("jazz", "blues", "folk", "food")]
+        db.session.add_all(tags)
+        db.session.commit()
+        jazz, blues, folk, food = [str(tag.id) for tag in tags]
+        user_id = self.user.id
+
+        post = Post.commit_new_post(user_id=user_id, title="Main", content="Hi.", tags=[jazz, blues])
+        both = Post.commit_new_post(user_id=user_id, title="Both", content="Hi.", tags=[jazz, blues, folk])
+        one = Post.commit_new_post(user_id=user_id, title="One", content="Hi.", tags=[blues])
+        Post.commit_new_post(user_id=user_id, title="Neither", content="Hi.", tags=[food])
+        post_id, both_id, one_id = post.id, both.id, one.id
+
+        links = related_index.links()
+        self.assertEqual(links.related_posts(post_id, [int(jazz), int(blues)]), [both_id, one_id])
+        self.assertEqual(links.related_tags([int(jazz), int(blues)]), [int(folk)])
+
+        with app.test_client() as client:
+            html = client.get(f'/posts/{post_id}').get_data(as_text=True)
+            self.assertLess(html.index("Both"), html.index("One"))
+            self.assertNotIn("Neither", html)
+            self.assertIn(">folk</span>", html)
+
+            # Detaching and attaching tags, and deleting a post, are applied to the loaded index as they commit
+            client.post(f'/posts/{one_id}/edit', data={"title": "One", "content": "Hi.", "tag": [jazz, blues, food]})
+            self.assertEqual(links.related_posts(post_id, [int(jazz), int(blues)]), [one_id, both_id])
+            self.assertEqual(links.related_tags([int(jazz), int(blues)]), [int(folk), int(food)])
+            client.post(f'/posts/{both_id}/delete')
+            self.assertEqual(links.related_posts(post_id, [int(jazz), int(blues)]), [one_id])
+            self.assertEqual(links.related_tags([int(jazz), int(blues)]), [int(food)])
+            html = client.get(f'/posts/{post_id}').get_data(as_text=True)
+            self.assertNotIn("Both", html)
+
+            client.post(f'/tags/{food}/delete')
+            self.assertEqual(related_index.links().related_tags([int(jazz), int(blues)]), [])
+
+    def test_related_index_reloads(self):
+        """
+        Test that a change the related index was loaded with isn't counted again when it's applied,
+        and that while one thread reloads expired links, other lookups get the expired ones rather than reloading too.
+        """
+        tags = [Tag(name=name) for name in ("jazz", "blues")]
+        db.session.add_all(tags)
+        db.session.commit()
+        jazz, blues = [tag.id for tag in tags]
+        post = Post.commit_new_post(user_id=self.user.id, title="Main", content="Hi.", tags=[str(jazz), str(blues)])
+
+        # As if a reload read the post's links before its commit got to apply them
+        related_index.clear()
+        links = related_index.links()
+        related_index.change(post.id, {jazz, blues})
+        self.assertEqual(links.cooccurrence[jazz][1].tolist(), [1])
+
+        loads = []
+        related_index.clear()
+        original_load = related_index._load
+        related_index._load = lambda: loads.append(1) or []
+        try:
+            with related_index._reload_lock:
+                # Another thread is reloading
+                self.assertIs(related_index.links(), links)
+            self.assertEqual(loads, [])
+            self.assertIsNot(related_index.links(), links)
+            self.assertEqual(loads, [1])
+        finally:
+            related_index._load = original_load
+
+    def test_filter_posts_by_tags(self):
+        """
+        Test that /posts?tags= lists the posts with all of the tags, or any of them with mode=any, newest first a page at a time,
+        that an unknown tag matches nothing for all and is ignored for any, and that a malformed filter is a 400.
+        """
+        tags = [Tag(name=name) for name in ("jazz", "blues", "folk")]
+        db.session.add_all(tags)
+        db.session.commit()
+        jazz, blues, folk = [str(tag.id) for tag in tags]
+        user_id = self.user.id
+
+        for title, tag_ids in [("Jazz only", [jazz]), ("Jazz and blues", [jazz, blues]), ("All three", [jazz, blues, folk]), ("Folk only", [folk])]:
+            Post.commit_new_post(user_id=user_id, title=title, content="Hi.", tags=tag_ids)
+
+        def titles(html):
+            return [title for title in ("Jazz only", "Jazz and blues", "All three", "Folk only") if f'>{title}</a>' in html]
+
+        with app.test_client() as client:
+            html = client.get('/posts?tags=Blues,jazz').get_data(as_text=True)
+            self.assertEqual(titles(html), ["Jazz and blues", "All three"])
+            self.assertIn("Posts tagged blues and jazz", html)
+            self.assertLess(html.index("All three"), html.index("Jazz and blues"))
+
+            self.assertEqual(titles(client.get('/posts?tags=blues,folk&mode=any').get_data(as_text=True)),
+                             ["Jazz and blues", "All three", "Folk only"])
+            self.assertEqual(titles(client.get('/posts?tags=jazz,nothing').get_data(as_text=True)), [])
+            self.assertEqual(titles(client.get('/posts?tags=folk,nothing&mode=any').get_data(as_text=True)), ["All three", "Folk only"])
+
+            seen = []
+            url = '/posts?tags=jazz&per_page=1'
+            while url:
+                html = client.get(url).get_data(as_text=True)
+                seen += titles(html)
+                url = next_page_link(html)
+            self.assertEqual(seen, ["All three", "Jazz and blues", "Jazz only"])
+
+            # A new post with the tags shows up, since it changes their posts
+            Post.commit_new_post(user_id=user_id, title="Folk only", content="Again.", tags=[folk, jazz])
+            self.assertIn(">Folk only</a>", client.get('/posts?tags=folk,jazz').get_data(as_text=True))
+
+            self.assertEqual(client.get('/posts?tags=jazz&mode=some').status_code, 400)
+            self.assertEqual(client.get('/posts?tags=' + ','.join(f'tag{n}' for n in range(11))).status_code, 400)
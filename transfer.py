@@ -0,0 +1,310 @@
+"""
+Move users, posts and tags into and out of the database as NDJSON or CSV files, one kind of row per file.
+
+    flask blogly export users users.ndjson
+    flask blogly export posts posts.csv
+    flask blogly import tags tags.ndjson
+    flask blogly import posts posts.csv --format csv
+
+The format comes from --format, or the file's extension (.csv for CSV, anything else is NDJSON). A file of - means stdin/stdout.
+Each record has the columns the JSON API shows, and posts carry the names of their tags as a list ("tags"),
+written as one comma separated field in CSV.
+
+Exports read from a server-side cursor, a batch at a time, so they run in constant memory.
+Imports read and write CHUNK_SIZE records at a time, in one transaction per chunk with a multi-row statement per table:
+- records with an id are upserted on it, so importing the same file twice changes nothing the second time,
+  and an interrupted import can be picked up again by running the same command
+- records without one are inserted as new rows
+- the tags of posts are looked up by name, a chunk at a time, and any that don't exist yet are created
+- a post's tag links are replaced by the ones in the file, when the record has a "tags" field
+Post counts are recomputed once an import of posts has finished.
+Every record needs the columns its table can't do without (REQUIRED_FIELDS), even when it has an id.
+A record that's missing one, has a value that doesn't parse, or isn't valid JSON or CSV stops the import
+with the line it's on. The chunks before it are already committed, so fix the line and run the import again.
+Only Postgres and SQLite are supported, since the upserts use their ON CONFLICT clause.
+
+Running servers keep their cached pages and tag registry until those expire (PAGE_CACHE_TTL and TAG_REGISTRY_TTL).
+"""
+import csv
+import json
+from collections import defaultdict
+from datetime import datetime
+from itertools import groupby, islice
+import click
+from flask.cli import AppGroup
+from sqlalchemy.dialects import postgresql, sqlite
+from api import USER_FIELDS, POST_FIELDS, TAG_FIELDS, STREAM_BATCH_SIZE, to_json
+from models import db, invalidate_on_commit, make_excerpt, repair_post_counts, reset_sequences, tag_links_on_commit, touch, User, Post, Tag, PostTag
+
+# Records per transaction when importing
+CHUNK_SIZE = 1000
+
+EXPORT_FIELDS = {'users': USER_FIELDS, 'posts': POST_FIELDS, 'tags': TAG_FIELDS}
+
+def timestamp(value):
+    return datetime.fromisoformat(value)
+
+def tag_names(value):
+    """A post's tag names, from a JSON list or a comma separated CSV field, lowercased like Tag.commit_new_tag does."""
+    if isinstance(value, str):
+        value = value.split(',')
+    return sorted({str(name).strip().lower() for name in value if str(name).strip()})
+
+# The fields an import reads for each kind of row, and how to parse them. Any others are ignored.
+IMPORT_FIELDS = {
+    'users': {'id': int, 'first_name': str, 'last_name': str, 'image': str, 'updated_at': timestamp},
+    'posts': {'id': int, 'user_id': int, 'title': str, 'content': str, 'created_at': timestamp, 'updated_at': timestamp, 'tags': tag_names},
+    'tags': {'id': int, 'name': str, 'updated_at': timestamp}
+}
+
+# The fields every record of each kind must have, for the NOT NULL columns with no default
+REQUIRED_FIELDS = {
+    'users': {'first_name'},
+    'posts': {'user_id', 'title', 'content'},
+    'tags': {'name'}
+}
+
+class BadRecord(click.ClickException):
+    """A record in an import file that can't be imported, reported with the line it's on."""
+
+    def __init__(self, line, problem):
+        super().__init__(f'Line {line}: {problem}')
+        self.line = line
+
+blogly = AppGroup('blogly', help='Import and export users, posts and tags.')
+
+def chunks(iterable, size):
+    """Split an iterable into lists of up to size items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def file_format(file, chosen):
+    return chosen or ('csv' if file.name.endswith('.csv') else 'ndjson')
+
+# Exports
+
+def export_records(kind):
+    """Every row of the kind, as dicts in id order. Posts have a list of their tag names, looked up one batch of posts at a time."""
+    fields = EXPORT_FIELDS[kind]
+    rows = db.session.query(*fields).order_by(fields[0]).execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+    for batch in chunks(rows, STREAM_BATCH_SIZE):
+        records = [row._asdict() for row in batch]
+        if kind == 'posts':
+            names = defaultdict(list)
+            for post_id, name in db.session.query(PostTag.post_id, Tag.name).join(Tag).filter(
+                PostTag.post_id.in_([record['id'] for record in records])
+            ).order_by(Tag.name):
+                names[post_id].append(name)
+            for record in records:
+                record['tags'] = names[record['id']]
+        yield from records
+
+def write_ndjson(records, file):
+    for record in records:
+        file.write(json.dumps(record, default=to_json) + '\n')
+
+def write_csv(records, file, columns):
+    writer = csv.DictWriter(file, fieldnames=columns, lineterminator='\n')
+    writer.writeheader()
+    for record in records:
+        writer.writerow({
+            column: value.isoformat() if isinstance(value, datetime) else ','.join(value) if isinstance(value, list) else value
+            for column, value in record.items()
+        })
+
+def export_file(kind, file, format='ndjson'):
+    """Write every row of the kind to the open file. Returns how many were written."""
+    written = 0
+
+    def counted(records):
+        nonlocal written
+        for record in records:
+            written += 1
+            yield record
+
+    records = counted(export_records(kind))
+    if format == 'csv':
+        write_csv(records, file, [field.key for field in EXPORT_FIELDS[kind]] + (['tags'] if kind == 'posts' else []))
+    else:
+        write_ndjson(records, file)
+    return written
+
+# Imports
+
+def read_ndjson(file):
+    """Each line's number and record, skipping blank lines."""
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            raise BadRecord(number, f'invalid JSON: {exc}')
+        if not isinstance(record, dict):
+            raise BadRecord(number, 'expected a JSON object')
+        yield number, record
+
+def read_csv(file):
+    """Each row's line number (its last line, for a row with quoted line breaks) and record."""
+    reader = csv.DictReader(file)
+    try:
+        for record in reader:
+            yield reader.line_num, record
+    except csv.Error as exc:
+        raise BadRecord(reader.line_num, f'invalid CSV: {exc}')
+
+def parse_record(kind, record, line):
+    """
+    Pick out and parse the fields we import for the kind.
+    Empty and null values are left out, so the column gets its default, except that an empty tags field means no tags.
+    Raises BadRecord if a value doesn't parse or a required field is missing.
+    """
+    fields = IMPORT_FIELDS[kind]
+    row = {}
+    for name, value in record.items():
+        if name in fields and (name == 'tags' or value not in (None, '')):
+            try:
+                row[name] = fields[name](value)
+            except (ValueError, TypeError) as exc:
+                raise BadRecord(line, f'invalid {name} {value!r}: {exc}')
+
+    missing = REQUIRED_FIELDS[kind] - set(row)
+    if missing:
+        raise BadRecord(line, f'missing {", ".join(sorted(missing))}')
+    return row
+
+def dialect_insert(table):
+    """An INSERT for the table that supports ON CONFLICT on the database we're connected to."""
+    inserts = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+    dialect = db.engine.dialect.name
+    if dialect not in inserts:
+        raise click.UsageError(f'Importing needs Postgres or SQLite, not {dialect}')
+    return inserts[dialect](table)
+
+def upsert(table, rows, key):
+    """
+    Insert the rows, updating the columns they have on any row that's already there with the same value in the key column.
+    Rows with the same set of columns go in one multi-row statement.
+    """
+    def columns(row):
+        return tuple(sorted(row))
+
+    for names, group in groupby(sorted(rows, key=columns), key=columns):
+        statement = dialect_insert(table)
+        update = {name: statement.excluded[name] for name in names if name != key}
+        if update:
+            statement = statement.on_conflict_do_update(index_elements=[key], set_=update)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[key])
+        db.session.execute(statement, list(group))
+
+def insert_new(model, rows):
+    """Insert rows without ids through the ORM, which gives us their new ids, and set them on the rows."""
+    if not rows:
+        return
+    new = [model(**row) for row in rows]
+    db.session.add_all(new)
+    db.session.flush()
+    for row, obj in zip(rows, new):
+        row['id'] = obj.id
+
+def tag_ids_by_name(names):
+    """
+    Look up the ids of the tags with the names, creating any that don't exist yet, in one statement each.
+    This runs on the primary inside the import's transaction, so it sees every tag, including ones created moments ago.
+    """
+    if not names:
+        return {}
+    db.session.execute(dialect_insert(Tag.__table__).on_conflict_do_nothing(index_elements=['name']), [{'name': name} for name in names])
+    return dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+
+def import_users(rows):
+    upsert(User.__table__, [row for row in rows if 'id' in row], 'id')
+    insert_new(User, [row for row in rows if 'id' not in row])
+
+def import_tags(rows):
+    for row in rows:
+        row['name'] = row['name'].lower()
+    upsert(Tag.__table__, [row for row in rows if 'id' in row], 'id')
+    tag_ids_by_name({row['name'] for row in rows if 'id' not in row})
+
+def import_posts(rows):
+    """Upsert the posts, then replace the tag links of the ones that list their tags."""
+    tags = [row.pop('tags') if 'tags' in row else None for row in rows]
+    for row in rows:
+        if 'content' in row:
+            row['excerpt'] = make_excerpt(row['content'])
+    upsert(Post.__table__, [row for row in rows if 'id' in row], 'id')
+    insert_new(Post, [row for row in rows if 'id' not in row])
+
+    # The details pages of the posts' users and tags list them
+    post_ids = [row['id'] for row in rows]
+    touch(User, db.select(Post.user_id).where(Post.id.in_(post_ids)))
+    touch(Tag, db.select(PostTag.tag_id).where(PostTag.post_id.in_(post_ids)))
+
+    tagged = [(row['id'], names) for row, names in zip(rows, tags) if names is not None]
+    if not tagged:
+        return
+
+    tag_ids = tag_ids_by_name({name for _, names in tagged for name in names})
+    PostTag.query.filter(PostTag.post_id.in_([post_id for post_id, _ in tagged])).delete(synchronize_session = False)
+    links = [{'post_id': post_id, 'tag_id': tag_ids[name]} for post_id, names in tagged for name in names]
+    if links:
+        db.session.execute(PostTag.__table__.insert(), links)
+        touch(Tag, {link['tag_id'] for link in links})
+    tag_links_on_commit(None, None)
+
+IMPORTERS = {'users': import_users, 'posts': import_posts, 'tags': import_tags}
+
+def import_records(kind, records, chunk_size=CHUNK_SIZE):
+    """
+    Import an iterable of (line number, record dict) pairs of the kind, committing chunk_size at a time.
+    Returns how many were imported.
+    """
+    imported = 0
+    for chunk in chunks((parse_record(kind, record, line) for line, record in records), chunk_size):
+        had_ids = any('id' in row for row in chunk)
+        IMPORTERS[kind](chunk)
+        if had_ids:
+            # Each kind is named after its table
+            reset_sequences(kind)
+
+        invalidate_on_commit('users', 'posts', 'tags')
+        db.session.commit()
+        imported += len(chunk)
+
+    if kind == 'posts':
+        repair_post_counts()
+    return imported
+
+def import_file(kind, file, format='ndjson', chunk_size=CHUNK_SIZE):
+    """Import the rows of the kind from the open file. Returns how many were imported."""
+    records = read_csv(file) if format == 'csv' else read_ndjson(file)
+    return import_records(kind, records, chunk_size=chunk_size)
+
+KINDS = click.Choice(['users', 'posts', 'tags'])
+FORMATS = click.Choice(['ndjson', 'csv'])
+
+@blogly.command('export')
+@click.argument('kind', type=KINDS)
+@click.argument('file', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'chosen_format', type=FORMATS, help='Defaults to csv for .csv files and ndjson otherwise.')
+def export_command(kind, file, chosen_format):
+    """Write every user, post or tag to FILE."""
+    written = export_file(kind, file, file_format(file, chosen_format))
+    click.echo(f'Exported {written} {kind}', err=True)
+
+@blogly.command('import')
+@click.argument('kind', type=KINDS)
+@click.argument('file', type=click.File('r', encoding='utf-8'), default='-')
+@click.option('--format', 'chosen_format', type=FORMATS, help='Defaults to csv for .csv files and ndjson otherwise.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True, help='Records per transaction.')
+def import_command(kind, file, chosen_format, chunk_size):
+    """Upsert users, posts or tags from FILE."""
+    imported = import_file(kind, file, file_format(file, chosen_format), chunk_size=max(1, chunk_size))
+    click.echo(f'Imported {imported} {kind}', err=True)
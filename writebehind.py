@@ -0,0 +1,144 @@
+"""
+Write-behind batching for the form submissions, turned on with WRITE_BEHIND=1.
+
+Instead of committing inside the request, the write routes put their commit_new_* call on a bounded in-process queue
+and redirect straight away. A background thread in each worker process takes the calls off the queue and runs them
+with commit=False, committing once per batch: WRITE_BATCH_SIZE writes, or however many arrived within WRITE_FLUSH_MS
+of the first. A burst of submissions then costs the primary one commit (and one fsync) per batch rather than one each.
+If a batch fails, it's rolled back and each of its writes is retried in a transaction of its own,
+so one bad submission doesn't lose the others.
+
+Backpressure: when the queue already holds WRITE_QUEUE_SIZE writes, a submission waits up to WRITE_QUEUE_TIMEOUT_MS
+for room, and then the route answers 503 with a Retry-After header.
+
+Durability: a queued write lives only in this process's memory until its batch commits.
+- The client gets its redirect before the write commits, so the page it lands on may not show the change yet.
+- A clean shutdown flushes the queue first: gunicorn's worker_exit hook (see gunicorn.conf.py) and interpreter exit both do it.
+- A crash, SIGKILL or out-of-memory kill loses everything still queued: up to WRITE_QUEUE_SIZE writes plus the batch in flight.
+- A write that fails, like a post for a user who was just deleted, fails after its response was sent,
+  so it's logged to the blogly.writes logger rather than reported to the client.
+Leave it off wherever an acknowledged submission has to survive a crash.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from models import db
+
+logger = logging.getLogger('blogly.writes')
+
+# Put on the queue by stop() to tell the worker thread to finish
+STOP = object()
+
+class QueueFull(Exception):
+    """The write queue stayed full for longer than a submission would wait."""
+
+class WriteQueue:
+    """
+    A bounded queue of model writes, committed in batches by a background thread.
+    Each write is a classmethod like User.commit_new_user that takes a commit argument.
+    The thread starts with the first submission, so it's always running in the process that queued the write,
+    even if the app was built before a fork.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.batch_size = 100
+        self.flush_seconds = 0.05
+        self.timeout = 1
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def configure(self, app):
+        """Take the settings from the app's WRITE_* config values, and run the writes in its app context. Flushes the queue first."""
+        self.stop()
+        self.app = app
+        self.batch_size = max(1, app.config['WRITE_BATCH_SIZE'])
+        self.flush_seconds = app.config['WRITE_FLUSH_MS'] / 1000
+        self.timeout = app.config['WRITE_QUEUE_TIMEOUT_MS'] / 1000
+        self._queue = queue.Queue(maxsize=max(1, app.config['WRITE_QUEUE_SIZE']))
+
+    def submit(self, write, *args, **kwargs):
+        """Queue a call of write(*args, commit=False, **kwargs). Raises QueueFull if there's no room within the timeout."""
+        self._start()
+        try:
+            self._queue.put((write, args, kwargs), timeout=self.timeout)
+        except queue.Full:
+            raise QueueFull()
+
+    def pending(self):
+        """Roughly how many writes are waiting."""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Wait until every write queued so far has been committed (or has failed)."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self):
+        """Commit everything queued and stop the worker thread. Safe to call more than once; the next submission starts it again."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(STOP)
+            thread.join()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='blogly-write-behind', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            writes = [item for item in batch if item is not STOP]
+            if writes:
+                with self.app.app_context():
+                    self._write(writes)
+            for _ in batch:
+                self._queue.task_done()
+            if len(writes) < len(batch):
+                return
+
+    def _next_batch(self):
+        """Wait for a write, then take whatever else arrives until the batch is full or the flush interval is up."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size and batch[-1] is not STOP:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, writes):
+        """Run the writes in one transaction, or one at a time if that fails."""
+        try:
+            for write, args, kwargs in writes:
+                write(*args, commit=False, **kwargs)
+            db.session.commit()
+            return
+        except Exception:
+            db.session.rollback()
+            if len(writes) == 1:
+                logger.exception('Queued write %s failed', writes[0][0].__qualname__)
+                return
+
+        for write, args, kwargs in writes:
+            try:
+                write(*args, **kwargs)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Queued write %s failed', write.__qualname__)
+
+write_queue = WriteQueue()
+
+# Daemon threads are killed at exit, after the atexit hooks, so this gets the last writes in first
+atexit.register(write_queue.stop)